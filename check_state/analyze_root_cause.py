@@ -1,29 +1,47 @@
 #!/usr/bin/env python
 
+import re
 import neo4j
-from common.openai_generic_assistant import OpenAIGenericAssistant
+import asyncio
+import functools
+from common.assistant_factory import make_assistant
+from common.openai_generic_assistant import json_schema_format
+from common.async_openai_generic_assistant import AsyncOpenAIGenericAssistant
+from common.kind_catalog import entity_name_key
 
-def setup_state_semantic_analyzer():
-    instructions = 'You are an expert in k8s, and can find the mistakes in the state, and can further determine whether the mistakes is related to the error message'
-    name = 'k8s-state-semantic-analyzer'
-    semanticAnalyzer = OpenAIGenericAssistant()
-    semanticAnalyzer.create_assistant(instructions, name, 'gpt-4')
-    semanticAnalyzer.create_thread()
-   
-    #semanticAnalyzer.retrieve_assistant(assistant_id="asst_Y9JKxkQAT6cPtzK8yx4Lv1ZD")
-    #semanticAnalyzer.retrieve_thread(thread_id="thread_AIBklLfHHYFUY3HPT6kUJ0ZE")
-    
-    print(semanticAnalyzer.assistant.id)
-    print(semanticAnalyzer.thread.id)
-    print(f'https://platform.openai.com/playground?assistant={semanticAnalyzer.assistant.id}&thread={semanticAnalyzer.thread.id}')
+STATE_SEMANTIC_ANALYZER_INSTRUCTIONS = 'You are an expert in k8s, and can find the mistakes in the state, and can further determine whether the mistakes is related to the error message'
+STATE_SEMANTIC_ANALYZER_NAME = 'k8s-state-semantic-analyzer'
+
+# the structure of the statepath report, enforced when the analyzer is set up with structured_output
+REPORT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'summary': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'kind': {'type': 'string'},
+                    'explanation': {'type': 'string'},
+                    'relevance_score': {'type': 'string'},
+                },
+                'required': ['kind', 'explanation', 'relevance_score'],
+                'additionalProperties': False,
+            },
+        },
+        'conclusion': {'type': 'string'},
+        'resolution': {'type': 'string'},
+    },
+    'required': ['summary', 'conclusion', 'resolution'],
+    'additionalProperties': False,
+}
+REPORT_RESPONSE_FORMAT = json_schema_format('statepath_report', REPORT_SCHEMA)
 
-    state_rule = """
+STATE_RULE = """
     In a Kubernetes system, each entity should have a corresponding STATE node which represents its existence and status. If an entity lacks a corresponding STATE node, it signifies a clear error, implying that this entity does not exist or its creation was unsuccessful. This is a fundamental principle that applies across various entities, including but not limited to, nfs (directory in Network File System), Secrets, and ConfigMaps. Therefore, as a best practice, always ensure that all entities have their respective STATE nodes to avoid such errors and maintain the system's robustness and performance.
     """
 
-    semanticAnalyzer.add_message(state_rule)
-
-    task_prompt = """
+TASK_PROMPT = """
     You will receive two separate pieces of information:
     1. A JSON string that represents the current state of a Kubernetes (k8s) object, which varies in type (e.g., PersistentVolume is one example).
     2. An error message that may or may not be associated with the k8s object.
@@ -39,9 +57,40 @@ def setup_state_semantic_analyzer():
 
     Proceed with these instructions when prompted with the k8s object's JSON string and error message.
     """
+
+# the state rule and the task are a part of the instructions rather than seeded messages,
+# so a registered Assistant is ready to use without seeding every new thread
+def build_state_semantic_analyzer_instructions():
+    return '\n\n'.join([STATE_SEMANTIC_ANALYZER_INSTRUCTIONS, STATE_RULE, TASK_PROMPT])
+
+# backend is 'assistants' (server-side thread) or 'chat' (stateless, constant cost per message)
+# assistant_options are passed to the assistant, i.e, response_cache, ledger, scheduler, registry, structured_output
+# (structured_output needs a model that supports it, i.e, gpt-4o)
+def setup_state_semantic_analyzer(backend='assistants', model='gpt-4', **assistant_options):
+    semanticAnalyzer = make_assistant(backend, stage='semantic', **assistant_options)
+    semanticAnalyzer.create_assistant(build_state_semantic_analyzer_instructions(), STATE_SEMANTIC_ANALYZER_NAME, model)
+    semanticAnalyzer.create_thread()
+   
+    #semanticAnalyzer.retrieve_assistant(assistant_id="asst_Y9JKxkQAT6cPtzK8yx4Lv1ZD")
+    #semanticAnalyzer.retrieve_thread(thread_id="thread_AIBklLfHHYFUY3HPT6kUJ0ZE")
     
-    semanticAnalyzer.add_message(task_prompt)
+    print(semanticAnalyzer.assistant.id)
+    print(semanticAnalyzer.thread.id)
+    print(f'https://platform.openai.com/playground?assistant={semanticAnalyzer.assistant.id}&thread={semanticAnalyzer.thread.id}')
+
+
+    return semanticAnalyzer
+
 
+# run_limiter is shared with the other async assistants to bound the concurrent runs
+# assistant_options are passed to the assistant, i.e, ledger, scheduler, registry, structured_output
+async def async_setup_state_semantic_analyzer(run_limiter=None, model='gpt-4', **assistant_options):
+    semanticAnalyzer = AsyncOpenAIGenericAssistant(run_limiter, stage='semantic', **assistant_options)
+    await semanticAnalyzer.create_assistant(build_state_semantic_analyzer_instructions(), STATE_SEMANTIC_ANALYZER_NAME, model)
+    await semanticAnalyzer.create_thread()
+
+    print(semanticAnalyzer.assistant.id)
+    print(semanticAnalyzer.thread.id)
 
     return semanticAnalyzer
 
@@ -49,15 +98,9 @@ def setup_state_semantic_analyzer():
 # we expect the time range of EVENT and STATE overlaps
 # namely, [E.tmin, E.tmax) ∩ [S.tmin, S.tmax) is not empty
 def find_loose_states(entityKind, entityId, tmin, tmax):
-    stateKind = entityKind.upper()
-    cypher_query = f"""
-    MATCH (n1:{entityKind})-[r1:HasState]->(n2:{stateKind})
-    WHERE n1.id = '{entityId}'
-    AND r1.tmin <= '{tmax}' AND r1.tmax > '{tmin}'
-    RETURN n2
-    LIMIT 10;
-    """
-    return cypher_query
+    cypher_query = loose_states_query(entityKind)
+    parameters = {'entityId': entityId, 'tmin': tmin, 'tmax': tmax}
+    return cypher_query, parameters
 
 # we expect the EVENT happens within the time range of STATE
 # namely, timestamp in [tmin, tmax)
@@ -68,54 +111,88 @@ def find_loose_states(entityKind, entityId, tmin, tmax):
 #     5 in [3, 5] and [5, 8], but 5 not in [3, 5), only in [5, 8)
 
 def find_strict_states(entityKind, entityId, timestamp):
-    stateKind = entityKind.upper()
+    cypher_query = strict_states_query(entityKind)
+    parameters = {'entityId': entityId, 'timestamp': timestamp}
+    return cypher_query, parameters
+
+# the labels can not be parameters, so only the kind goes into the query text and the values are parameters,
+# there is one query text per kind, Neo4j plans it once and reuses the plan for every entity of the kind
+KIND_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+# the kinds of the metagraph, once registered the labels are drawn from them only
+ENTITY_KINDS = set()
+ENTITY_KINDS_UPPER = set()
+
+# kinds: any iterable of kinds, i.e, the kinds of a KindCatalog
+def register_entity_kinds(kinds):
+    ENTITY_KINDS.update(kinds)
+    ENTITY_KINDS_UPPER.update(x.upper() for x in kinds)
+
+def kind_label(kind):
+    if (not KIND_PATTERN.match(kind)) or (ENTITY_KINDS and (kind not in ENTITY_KINDS) \
+            and (kind.upper() not in ENTITY_KINDS_UPPER)):
+        raise ValueError(f'unknown entity kind {kind!r}')
+    return f'`{kind}`'
+
+@functools.lru_cache(maxsize=None)
+def loose_states_query(entityKind):
     cypher_query = f"""
-    MATCH (n1:{entityKind})-[r1:HasState]->(n2:{stateKind})
-    WHERE n1.id = '{entityId}'
-    AND r1.tmin <= '{timestamp}' AND r1.tmax > '{timestamp}'
+    MATCH (n1:{kind_label(entityKind)})-[r1:HasState]->(n2:{kind_label(entityKind.upper())})
+    WHERE n1.id = $entityId
+    AND r1.tmin <= $tmax AND r1.tmax > $tmin
     RETURN n2
     LIMIT 10;
     """
     return cypher_query
 
-# the statepath is a neo4j record returned by running query for metapath
-def check_statepath(query_executor, semanticAnalyzer, statepath):
-    # get timestamp, tmin, tmax, error_message from EVENT node
+@functools.lru_cache(maxsize=None)
+def strict_states_query(entityKind):
+    cypher_query = f"""
+    MATCH (n1:{kind_label(entityKind)})-[r1:HasState]->(n2:{kind_label(entityKind.upper())})
+    WHERE n1.id = $entityId
+    AND r1.tmin <= $timestamp AND r1.tmax > $timestamp
+    RETURN n2
+    LIMIT 10;
+    """
+    return cypher_query
+
+@functools.lru_cache(maxsize=None)
+def entity_query(entityKind):
+    cypher_query = f"""
+    match (n1:{kind_label(entityKind)})
+    where n1.id = $entityId
+    return n1
+    limit 1
+    """
+    return cypher_query
+
+# get timestamp and error_message from the Event node of the statepath
+def get_statepath_event(statepath):
+    timestamp, error_message = None, None
     for ele in statepath:
         if isinstance(ele, neo4j.graph.Node) and (ele['kind'] == 'Event'):
             timestamp = ele['timestamp']
             #tmin = timestamp
             #tmax = ele['nextTimestamp']
             error_message = ele['message']
-    
-    # check the state of entity node, except Event node (note: 'kind' and 'kind2' are different keys) 
-    path_clues = dict()
-    # state['kind'] == native_entity['kind2'], i.e, Pod['kind2'] == POD['kind'] == 'Pod'
-    # state['kind'] == external_entity['tag'], i.e. nfs['tag'] == NFS['kind'] == 'nfs'
-    kind2_tags = []
+    return timestamp, error_message
+
+# the (kind, id) of the entity nodes in the statepath, except the Event node (note: 'kind' and 'kind2' are different keys) 
+# state['kind'] == native_entity['kind2'], i.e, Pod['kind2'] == POD['kind'] == 'Pod'
+# state['kind'] == external_entity['tag'], i.e. nfs['tag'] == NFS['kind'] == 'nfs'
+def get_statepath_entities(statepath):
+    entities = []
     for ele in statepath:
         if isinstance(ele, neo4j.graph.Node) and not ((ele['kind2'] == 'Event') or (ele['kind'] == 'Event')):
             if ele['isNative'] == 'true':
                 entity_kind = ele['kind2']
             elif ele['isNative'] == 'false':
                 entity_kind = ele['tag']
-            entity_id = ele['id']
-            
-            print(entity_kind, entity_id)
-            kind2_tags.append(entity_kind)
-            
-            '''
-            cypher_query = find_strict_states(entity_kind, entity_id, timestamp)
-            node_clues = check_states_existence_and_semantic(query_executor, cypher_query,\
-                            semanticAnalyzer, error_message)
-            '''
-            node_clues = check_states_of_entity(entity_kind, entity_id, error_message, timestamp,\
-                            query_executor, semanticAnalyzer)
-            #path_clues[entity_id] = node_clues
-            path_clues[f'{entity_kind}({entity_id})'] = node_clues
+            entities.append((entity_kind, ele['id']))
+    return entities
 
-    # summarize the node clues, make a conclusion, and provide a resolution
-    kinds = (', ').join(kind2_tags)
+# previous_analysis carries the clues when the analyzer can not see them in its history
+def build_report_prompt(kinds, previous_analysis=None):
     prompt_task = f"""Based on the previous analysis of {kinds}, summarize the root cause of the error message,\
     and pinpoint out the most relevant parts. For each kind, provide a score (0~10/10) to indicate how relevant\
     it is to the error message. Moreover, provide a resolution for the error with kubectl or bash command if appliable.\
@@ -137,24 +214,93 @@ def check_statepath(query_executor, semanticAnalyzer, statepath):
     "resolution": "<actions to resolve the error, with kubectl/bash command>"
     }
     """
-    prompt = prompt_task + prompt_output
+    if previous_analysis is not None:
+        prompt_task = f"The previous analysis is:\n{previous_analysis}\n" + prompt_task
+    return prompt_task + prompt_output
+
+# the statepath is a neo4j record returned by running query for metapath
+# state_lookup is from lookup_statepath_states, i.e, for all the statepaths of a query at once,
+# batched: look up the states of the statepath in one query if no state_lookup is given, instead of per entity
+def check_statepath(query_executor, semanticAnalyzer, statepath, state_lookup=None, batched=False):
+    # get timestamp, tmin, tmax, error_message from EVENT node
+    timestamp, error_message = get_statepath_event(statepath)
+    if batched and (state_lookup is None):
+        state_lookup = lookup_statepath_states(query_executor, [statepath])
+    
+    # the state lookups of all entities share one session, it is released before the semantic checks,
+    # so no connection is held while gpt-4 answers
+    entities = get_statepath_entities(statepath)
+    with query_executor.session_scope():
+        lookups = [lookup_states_of_entity(entity_kind, entity_id, timestamp, query_executor, state_lookup)
+                   for entity_kind, entity_id in entities]
+
+    # check the state of entity node, except Event node
+    path_clues = dict()
+    kind2_tags = []
+    for (entity_kind, entity_id), (state_nodes, entity_name) in zip(entities, lookups):
+        print(entity_kind, entity_id)
+        kind2_tags.append(entity_kind)
+
+        '''
+        cypher_query, parameters = find_strict_states(entity_kind, entity_id, timestamp)
+        node_clues = check_states_existence_and_semantic(query_executor, cypher_query,\
+                        semanticAnalyzer, error_message, parameters)
+        '''
+        node_clues = analyze_states_of_entity(entity_kind, entity_id, error_message, state_nodes, entity_name,\
+                        semanticAnalyzer)
+        #path_clues[entity_id] = node_clues
+        path_clues[f'{entity_kind}({entity_id})'] = node_clues
+
+    # summarize the node clues, make a conclusion, and provide a resolution
+    kinds = (', ').join(kind2_tags)
+    previous_analysis = None
+    if semanticAnalyzer.stateless:
+        previous_analysis = '\n'.join(clue for clues in path_clues.values() for clue in clues)
+    prompt = build_report_prompt(kinds, previous_analysis)
 
     # add message and run assistant 
     semanticAnalyzer.add_message(prompt)
     print('run assistant')
-    semanticAnalyzer.run_assistant()
+    semanticAnalyzer.run_assistant(response_format=REPORT_RESPONSE_FORMAT)
     messages = semanticAnalyzer.wait_get_last_k_message(1)
     report = messages.data[0].content[0].text.value 
     
     # the report provide a summary, the path_clues provide details
     return report, path_clues
 
+# the async counterpart of check_statepath, query_executor is an AsyncNeo4jQueryExecutor,
+# the state lookups and the semantic checks of all entities run at the same time,
+# each on its own thread, so the summary prompt carries the clues instead of relying on the thread history
+async def async_check_statepath(query_executor, semanticAnalyzer, statepath, state_lookup=None, batched=False):
+    timestamp, error_message = get_statepath_event(statepath)
+    if batched and (state_lookup is None):
+        state_lookup = await async_lookup_statepath_states(query_executor, [statepath])
+
+    entities = get_statepath_entities(statepath)
+    kind2_tags = [entity_kind for entity_kind, entity_id in entities]
+    node_clues = await asyncio.gather(*[
+        async_check_states_of_entity(entity_kind, entity_id, error_message, timestamp, query_executor, semanticAnalyzer,
+                                     state_lookup)
+        for entity_kind, entity_id in entities])
+
+    path_clues = dict()
+    for (entity_kind, entity_id), clues in zip(entities, node_clues):
+        path_clues[f'{entity_kind}({entity_id})'] = clues
+
+    kinds = (', ').join(kind2_tags)
+    previous_analysis = '\n'.join(clue for clues in node_clues for clue in clues)
+    prompt = build_report_prompt(kinds, previous_analysis)
+    messages = await semanticAnalyzer.ask(prompt, response_format=REPORT_RESPONSE_FORMAT)
+    report = messages.data[0].content[0].text.value
+
+    return report, path_clues
+
 
 
 # there's usually only one state node for the entity node, but sometimes it can be more than one
-def check_states_existence_and_semantic(query_executor, cypher_query, semanticAnalyzer, error_message):
+def check_states_existence_and_semantic(query_executor, cypher_query, semanticAnalyzer, error_message, parameters=None):
     clues = []
-    records = query_executor.run_query(cypher_query)
+    records = query_executor.run_query(cypher_query, parameters, stage='state')
     # step1: check whether the STATE node exist
     if len(records) == 0:
         state_not_exist = 'There is not a STATE node corresponds to the Entity node' 
@@ -169,23 +315,52 @@ def check_states_existence_and_semantic(query_executor, cypher_query, semanticAn
 
     return clues
 
+# the STATE nodes of the entity from the state_lookup (see lookup_statepath_states), and the entity node,
+# (None, None) if the entity is not looked up
+def get_looked_up_states(state_lookup, entity_kind, entity_id, timestamp):
+    if state_lookup is None:
+        return None, None
+    return state_lookup.get((entity_kind, entity_id, timestamp), (None, None))
+
+def build_state_not_exist(entity_kind, entity_id, entity_name):
+    return f"{entity_kind} ({entity_id}): there is not a STATE ({entity_kind.upper()}) node corresponds to the Entity ({entity_kind}) node, which is an apparent error. we confirm that {entity_name} does not exist."
+
+# the Neo4j part of check_states_of_entity: the STATE nodes of an Entity node,
+# and the name of the entity if it has none, return (state_nodes, entity_name)
+def lookup_states_of_entity(entity_kind, entity_id, timestamp, query_executor, state_lookup=None):
+    state_nodes, entity = get_looked_up_states(state_lookup, entity_kind, entity_id, timestamp)
+    if state_nodes is None:
+        # generate cypher_query and retrieve records
+        cypher_query, parameters = find_strict_states(entity_kind, entity_id, timestamp) 
+        records = query_executor.run_query(cypher_query, parameters, stage='state')
+        state_nodes = [record['n2'] for record in records]
+    entity_name = None
+    if len(state_nodes) == 0:
+        if entity is not None:
+            entity_name = get_entity_name(entity)
+        else:
+            entity_name = ad_hoc_find_entity_name(entity_kind, entity_id, query_executor)
+    return state_nodes, entity_name
+
 # check the existence and semantic of the STATE node for an Entity node
-def check_states_of_entity(entity_kind, entity_id, error_message, timestamp, query_executor, semanticAnalyzer):
-    # generate cypher_query and retrieve records
-    cypher_query = find_strict_states(entity_kind, entity_id, timestamp) 
-    records = query_executor.run_query(cypher_query)
-    
+def check_states_of_entity(entity_kind, entity_id, error_message, timestamp, query_executor, semanticAnalyzer,
+                           state_lookup=None):
+    state_nodes, entity_name = lookup_states_of_entity(entity_kind, entity_id, timestamp, query_executor, state_lookup)
+    return analyze_states_of_entity(entity_kind, entity_id, error_message, state_nodes, entity_name, semanticAnalyzer)
+
+# the LLM part of check_states_of_entity, on the looked up STATE nodes
+def analyze_states_of_entity(entity_kind, entity_id, error_message, state_nodes, entity_name, semanticAnalyzer):
     # check whether the STATE node exist
     clues = []
-    if len(records) == 0:
-        entity_name = ad_hoc_find_entity_name(entity_kind, entity_id, query_executor)
-        state_not_exist = f"{entity_kind} ({entity_id}): there is not a STATE ({entity_kind.upper()}) node corresponds to the Entity ({entity_kind}) node, which is an apparent error. we confirm that {entity_name} does not exist."
+    if len(state_nodes) == 0:
+        state_not_exist = build_state_not_exist(entity_kind, entity_id, entity_name)
         clues.append(state_not_exist)
-        semanticAnalyzer.add_message(state_not_exist)
+        # a stateless analyzer gets the clue in the summary prompt instead
+        if not semanticAnalyzer.stateless:
+            semanticAnalyzer.add_message(state_not_exist)
     # check the content of the STATE node with gpt-4 using semantic analysis
     else:
-        for record in records:
-            state_node = record['n2']
+        for state_node in state_nodes:
             state_node_semantic = check_semantic(state_node, error_message, semanticAnalyzer)
             clues.append(state_node['kind'].upper() + '(' + state_node['id'] + '): ' + state_node_semantic)
    
@@ -196,31 +371,113 @@ def check_states_of_entity(entity_kind, entity_id, error_message, timestamp, que
 
     return clues
 
+# the async counterpart of check_states_of_entity, query_executor is an AsyncNeo4jQueryExecutor,
+# so the state lookups of all entities on the statepath are issued together,
+# the semantic checks of the STATE nodes run at the same time
+async def async_check_states_of_entity(entity_kind, entity_id, error_message, timestamp, query_executor, semanticAnalyzer,
+                                       state_lookup=None):
+    state_nodes, entity = get_looked_up_states(state_lookup, entity_kind, entity_id, timestamp)
+    if state_nodes is None:
+        cypher_query, parameters = find_strict_states(entity_kind, entity_id, timestamp)
+        records = await query_executor.run_query(cypher_query, parameters, stage='state')
+        state_nodes = [record['n2'] for record in records]
+
+    clues = []
+    if len(state_nodes) == 0:
+        if entity is not None:
+            entity_name = get_entity_name(entity)
+        else:
+            entity_name = await async_ad_hoc_find_entity_name(entity_kind, entity_id, query_executor)
+        clues.append(build_state_not_exist(entity_kind, entity_id, entity_name))
+    else:
+        semantics = await asyncio.gather(*[async_check_semantic(state_node, error_message, semanticAnalyzer)
+                                           for state_node in state_nodes])
+        for state_node, state_node_semantic in zip(state_nodes, semantics):
+            clues.append(state_node['kind'].upper() + '(' + state_node['id'] + '): ' + state_node_semantic)
+
+    return clues
+
 # we want to test whether adding the entity name to the state_not_exist will get better result
 def ad_hoc_find_entity_name(entity_kind, entity_id, query_executor):
-    cypher_query = f"""
-    match (n1:{entity_kind})
-    where n1.id = '{entity_id}'
-    return n1
-    limit 1
-    """
-    records = query_executor.run_query(cypher_query)
-    entity = records[0]['n1']
-
-    if entity['isNative'] == 'true':
-        key = 'name2'
-    elif entity['isAtomic'] == 'true':
-        key = 'val'
-    elif entity['tag'] in ['nfs', 'hostPath']:
-        key = 'path'
-    elif entity['tag'] == 'container':
-        key = 'containerName'
-    elif entity['tag'] == 'image':
-        key = 'imageName' 
-    
-    return entity[key]
+    cypher_query, parameters = find_entity(entity_kind, entity_id)
+    records = query_executor.run_query(cypher_query, parameters, stage='state')
+    return get_entity_name(records[0]['n1'])
 
-def check_semantic(state_node, error_message, semanticAnalyzer):
+async def async_ad_hoc_find_entity_name(entity_kind, entity_id, query_executor):
+    cypher_query, parameters = find_entity(entity_kind, entity_id)
+    records = await query_executor.run_query(cypher_query, parameters, stage='state')
+    return get_entity_name(records[0]['n1'])
+
+def find_entity(entity_kind, entity_id):
+    return entity_query(entity_kind), {'entityId': entity_id}
+
+# the STATE nodes of many entities in one query, items are (entity_kind, entity_id, timestamp),
+# the labels can not be parameters, so the items are grouped by kind into one UNWIND branch per kind,
+# the entity node is returned too, so the name of an entity without a STATE node needs no more query
+def find_batched_states(items):
+    kinds = sorted({entity_kind for entity_kind, entity_id, timestamp in items})
+    parameters = dict()
+    for i, kind in enumerate(kinds):
+        parameters[f'kind_{i}'] = kind
+        parameters[f'items_{i}'] = [{'id': entity_id, 'timestamp': timestamp}
+                                    for entity_kind, entity_id, timestamp in items if entity_kind == kind]
+    return batched_states_query(tuple(kinds)), parameters
+
+# the same kinds (i.e, the statepaths of one metapath) share the query text
+@functools.lru_cache(maxsize=None)
+def batched_states_query(kinds):
+    branches = []
+    for i, kind in enumerate(kinds):
+        branches.append(f"""
+    UNWIND $items_{i} AS item
+    MATCH (n1:{kind_label(kind)})
+    WHERE n1.id = item.id
+    OPTIONAL MATCH (n1)-[r1:HasState]->(n2:{kind_label(kind.upper())})
+    WHERE r1.tmin <= item.timestamp AND r1.tmax > item.timestamp
+    WITH item, n1, collect(DISTINCT n2) AS states
+    RETURN $kind_{i} AS kind, item.id AS id, item.timestamp AS timestamp, n1, states[..10] AS states
+    """)
+    return 'UNION ALL'.join(branches)
+
+# the distinct (entity_kind, entity_id, timestamp) of the entities on the statepaths,
+# the statepaths of a metapath share the Event timestamp and mostly the same entities
+def get_statepath_state_items(statepaths):
+    items = []
+    seen = set()
+    for statepath in statepaths:
+        timestamp, error_message = get_statepath_event(statepath)
+        for entity_kind, entity_id in get_statepath_entities(statepath):
+            if (entity_kind, entity_id, timestamp) not in seen:
+                seen.add((entity_kind, entity_id, timestamp))
+                items.append((entity_kind, entity_id, timestamp))
+    return items
+
+def index_batched_states(records):
+    state_lookup = dict()
+    for record in records:
+        state_lookup[(record['kind'], record['id'], record['timestamp'])] = (record['states'], record['n1'])
+    return state_lookup
+
+# the STATE nodes and the entity nodes of all entities on the statepaths in one round trip,
+# keyed by (entity_kind, entity_id, timestamp), an entity not in the stategraph is left out
+def lookup_statepath_states(query_executor, statepaths):
+    items = get_statepath_state_items(statepaths)
+    if len(items) == 0:
+        return dict()
+    cypher_query, parameters = find_batched_states(items)
+    return index_batched_states(query_executor.run_query(cypher_query, parameters, stage='state'))
+
+async def async_lookup_statepath_states(query_executor, statepaths):
+    items = get_statepath_state_items(statepaths)
+    if len(items) == 0:
+        return dict()
+    cypher_query, parameters = find_batched_states(items)
+    return index_batched_states(await query_executor.run_query(cypher_query, parameters, stage='state'))
+
+def get_entity_name(entity):
+    return entity[entity_name_key(entity)]
+
+def build_semantic_prompt(state_node, error_message):
     # pick fileds that are important to check
     important_fields = ['status', 'spec', 'path','server','subsets','roleRef','subjects',\
                         'rules','webhooks','secrets', 'data', 'metadata'] #'metadata' can be ignored 
@@ -237,6 +494,10 @@ def check_semantic(state_node, error_message, semanticAnalyzer):
     The error message is:\n{error_message} \n
     The JSON is:\n{tmp}
     """
+    return prompt
+
+def check_semantic(state_node, error_message, semanticAnalyzer):
+    prompt = build_semantic_prompt(state_node, error_message)
     print(prompt)
    
    # add message and run assistant 
@@ -249,4 +510,11 @@ def check_semantic(state_node, error_message, semanticAnalyzer):
     
     return clue
 
+async def async_check_semantic(state_node, error_message, semanticAnalyzer):
+    prompt = build_semantic_prompt(state_node, error_message)
+    # every check runs on its own thread, so the checks can overlap
+    checker = await semanticAnalyzer.fork()
+    messages = await checker.ask(prompt)
+    clue = messages.data[0].content[0].text.value
 
+    return clue
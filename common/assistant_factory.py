@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+
+from common.openai_generic_assistant import OpenAIGenericAssistant
+from common.openai_chat_assistant import OpenAIChatAssistant
+from common.llm_replay import OpenAIReplayAssistant
+
+
+# 'assistants': the conversation lives in a server-side thread
+# 'chat': stateless, every run sends the instructions and the current request only
+# 'replay': offline, answer from an LLMRecording made with one of the backends above
+ASSISTANT_BACKENDS = {
+    'assistants': OpenAIGenericAssistant,
+    'chat': OpenAIChatAssistant,
+    'replay': OpenAIReplayAssistant,
+}
+
+
+def make_assistant(backend='assistants', **kwargs):
+    if backend not in ASSISTANT_BACKENDS:
+        raise ValueError(f'unknown assistant backend: {backend}, choose from {list(ASSISTANT_BACKENDS)}')
+    return ASSISTANT_BACKENDS[backend](**kwargs)
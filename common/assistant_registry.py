@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+
+import os
+import json
+import time
+import hashlib
+
+
+# the ids of the Assistants created before, keyed by a hash of name + instructions + model,
+# so a new process looks the Assistant up instead of creating one, and a changed prompt gets a new Assistant
+class AssistantRegistry:
+    def __init__(self, path='./cache/assistant_registry.json'):
+        self.path = path
+        self.assistants = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.assistants = json.load(f)
+
+    @staticmethod
+    def assistant_key(name, instructions, model):
+        content = '\x00'.join([name, instructions, model])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def lookup(self, name, instructions, model):
+        entry = self.assistants.get(self.assistant_key(name, instructions, model))
+        return entry['id'] if entry is not None else None
+
+    def register(self, name, instructions, model, assistant_id):
+        self.assistants[self.assistant_key(name, instructions, model)] = \
+            {'id': assistant_id, 'name': name, 'model': model, 'created_at': time.time()}
+        self.save()
+
+    def forget(self, name, instructions, model):
+        self.assistants.pop(self.assistant_key(name, instructions, model), None)
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.assistants, f, indent=4)
+        os.replace(tmp_path, self.path)
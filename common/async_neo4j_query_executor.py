@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import time
+import collections
+from contextlib import aclosing
+from neo4j import AsyncGraphDatabase, READ_ACCESS
+
+from common.query_profiler import total_db_hits
+
+# the asyncio counterpart of Neo4jQueryExecutor, with the same run_query surface (awaitable),
+# so the queries to the metagraph and the stategraph, or the state lookups of a statepath, can overlap
+class AsyncNeo4jQueryExecutor:
+    # the options are the same as Neo4jQueryExecutor, the concurrent queries are bounded by max_connection_pool_size
+    def __init__(self, uri, user, password, max_connection_pool_size=50, connection_acquisition_timeout=60,
+                 fetch_size=1000, database=None, profiler=None):
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password),
+                                                max_connection_pool_size=max_connection_pool_size,
+                                                connection_acquisition_timeout=connection_acquisition_timeout)
+        self.fetch_size = fetch_size
+        self.database = database
+        self.profiler = profiler
+        # how many times each query text is run, see repeated_query_stats
+        self.query_counts = collections.Counter()
+
+    @classmethod
+    async def connect(cls, uri, user, password, **options):
+        # create the executor and verify the connection, like Neo4jQueryExecutor does in its constructor
+        executor = cls(uri, user, password, **options)
+        await executor.driver.verify_connectivity()
+        return executor
+
+    async def close(self):
+        # Close the connection to the database
+        await self.driver.close()
+
+    def new_session(self, fetch_size=None):
+        # every query of the pipeline is a read, so the session is opened in read mode
+        return self.driver.session(database=self.database, fetch_size=fetch_size or self.fetch_size,
+                                   default_access_mode=READ_ACCESS)
+
+    @staticmethod
+    async def read_records(tx, query, parameters):
+        # the records must be consumed before the transaction ends, the summary carries the server timings
+        result = await tx.run(query, parameters)
+        records = [record async for record in result]
+        return records, await result.consume()
+
+    def profile_query(self, query, stage):
+        # see Neo4jQueryExecutor.profile_query
+        if (self.profiler is not None) and self.profiler.profile_db_hits and (stage is not None):
+            return 'PROFILE ' + query
+        return query
+
+    def record_profile(self, stage, query, start, summary, records):
+        if self.profiler is None:
+            return
+        wall_ms = (time.time() - start) * 1000
+        if summary is None:
+            self.profiler.record(stage, query, wall_ms, records=records)
+        else:
+            self.profiler.record(stage, query, wall_ms, summary.result_available_after, summary.result_consumed_after,
+                                 records, total_db_hits(summary.profile))
+
+    async def run_query(self, query, parameters=None, stage=None):
+        # an async session is cheap and must not be shared between concurrent tasks, so every query opens one,
+        # the query runs in a managed read transaction, the driver retries it on transient errors
+        self.query_counts[query] += 1
+        start = time.time()
+        async with self.new_session() as session:
+            records, summary = await session.execute_read(self.read_records, self.profile_query(query, stage), parameters)
+        self.record_profile(stage, query, start, summary, len(records))
+        return records
+
+    async def stream_query(self, query, parameters=None, fetch_size=None, stage=None):
+        # yield the records as they are pulled from the server, see Neo4jQueryExecutor.stream_query
+        self.query_counts[query] += 1
+        start = time.time()
+        summary = None
+        count = 0
+        try:
+            async with self.new_session(fetch_size) as session:
+                async with await session.begin_transaction() as tx:
+                    result = await tx.run(self.profile_query(query, stage), parameters)
+                    async for record in result:
+                        count += 1
+                        yield record
+                    summary = await result.consume()
+        finally:
+            self.record_profile(stage, query, start, summary, count)
+
+    async def find_first_n(self, query, parameters=None, n=1, predicate=None, fetch_size=None, stage=None):
+        # the first n records that satisfy the predicate, stop pulling records as soon as we have them
+        matched = []
+        if n <= 0:
+            return matched
+        async with aclosing(self.stream_query(query, parameters, fetch_size, stage)) as records:
+            async for record in records:
+                if (predicate is None) or predicate(record):
+                    matched.append(record)
+                    if len(matched) == n:
+                        break
+        return matched
+
+    def repeated_query_stats(self):
+        # see Neo4jQueryExecutor.repeated_query_stats
+        queries = sum(self.query_counts.values())
+        distinct = len(self.query_counts)
+        return {'queries': queries, 'distinct_queries': distinct,
+                'repeated_text_ratio': (queries - distinct) / queries if queries else 0.0}
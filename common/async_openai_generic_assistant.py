@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+
+import os
+import asyncio
+import time
+import openai
+from types import SimpleNamespace
+from openai import AsyncOpenAI
+
+from common.openai_generic_assistant import TERMINAL_RUN_STATUSES
+from common.token_ledger import usage_to_dict
+from common.llm_scheduler import retry_after_seconds, is_rate_limited_run
+
+
+# share one limiter between the assistants on an event loop to bound how many runs are active at once
+def make_run_limiter(max_concurrent_runs=4):
+    return asyncio.Semaphore(max_concurrent_runs)
+
+
+# the asyncio counterpart of OpenAIGenericAssistant, every call to the API is awaitable,
+# so that several assistants (or several threads of one assistant) can run at the same time
+class AsyncOpenAIGenericAssistant:
+    def __init__(self, run_limiter=None, poll_interval=0.5, max_poll_interval=5, timeout=600, client=None,
+                 ledger=None, stage=None, scheduler=None, registry=None, structured_output=False, cancel_timeout=30):
+        # Initialize the OpenAI client with the API key from environment variable
+        if client is None:
+            openai.api_key = os.getenv("OPENAI_API_KEY")
+            client = AsyncOpenAI()
+        self.client = client
+        self.run_limiter = run_limiter if run_limiter is not None else make_run_limiter()
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.cancel_timeout = cancel_timeout
+        self.run = None
+        self.run_timing = None
+        self.ledger = ledger
+        self.stage = stage
+        self.last_usage = None
+        self.scheduler = scheduler
+        # the tokens reserved in the scheduler for the current run, settled once the run reports its usage
+        self.run_estimate = 0
+        self.registry = registry
+        self.structured_output = structured_output
+        self.registered_assistant = False
+
+    async def create_assistant(self, instructions, name, model='gpt-4'):
+        # reuse the registered Assistant without any API call, its id is all a run needs
+        self.registered_assistant = False
+        if self.registry is not None:
+            assistant_id = self.registry.lookup(name, instructions, model)
+            if assistant_id is not None:
+                self.assistant = SimpleNamespace(id=assistant_id, name=name, instructions=instructions, model=model)
+                self.registered_assistant = True
+                return
+
+        # Create an Assistant
+        self.assistant = await self.client.beta.assistants.create(
+                instructions=instructions,
+                name=name,
+                model=model,
+        )
+        if self.registry is not None:
+            self.registry.register(name, instructions, model, self.assistant.id)
+
+    async def retrieve_assistant(self, assistant_id):
+        # Retrive an existing Assistant
+        self.assistant = await self.client.beta.assistants.retrieve(assistant_id)
+
+    async def create_thread(self, messages=None):
+        # Create a Thread, optionally seeded with user messages in the same request
+        seed = [{'role': 'user', 'content': content} for content in (messages or [])]
+        self.thread = await self.client.beta.threads.create(messages=seed)
+        self.run = None
+
+    async def retrieve_thread(self, thread_id):
+        # Retrieve an existing Thread
+        self.thread = await self.client.beta.threads.retrieve(thread_id)
+        self.run = None
+
+    async def fork(self, seed_messages=None):
+        # a sibling on a new thread, it shares the client, the assistant and the limiter,
+        # a thread only allows one active run, so concurrent runs need their own threads
+        sibling = AsyncOpenAIGenericAssistant(self.run_limiter, self.poll_interval, self.max_poll_interval,
+                                              self.timeout, self.client, self.ledger, self.stage, self.scheduler,
+                                              self.registry, self.structured_output, self.cancel_timeout)
+        sibling.assistant = self.assistant
+        sibling.registered_assistant = self.registered_assistant
+        await sibling.create_thread(seed_messages)
+        return sibling
+
+    async def add_message(self, content):
+        # Add a Message to a Thread
+        await self.wait_thread_writable()
+        self.message = await self.client.beta.threads.messages.create(
+            thread_id=self.thread.id,
+            role="user",
+            content=content
+        )
+
+    # response_format is applied only when the assistant is set up with structured_output
+    async def run_assistant(self, instructions=None, response_format=None):
+        # Run the Assistant
+        await self.wait_thread_writable()
+        self.run_start = time.time()
+        self.last_usage = None
+        if not self.structured_output:
+            response_format = None
+        try:
+            await self.start_run(instructions, response_format)
+        except openai.NotFoundError:
+            if not self.registered_assistant:
+                raise
+            # the registered Assistant was deleted on the server, create it again and register the new one
+            print('the registered assistant %s is not found, create it again' % self.assistant.id)
+            self.registry.forget(self.assistant.name, self.assistant.instructions, self.assistant.model)
+            await self.create_assistant(self.assistant.instructions, self.assistant.name, self.assistant.model)
+            await self.start_run(instructions, response_format)
+
+    async def start_run(self, instructions=None, response_format=None):
+        self.run = await self.client.beta.threads.runs.create(
+            thread_id=self.thread.id,
+            assistant_id=self.assistant.id,
+            instructions=instructions,
+            response_format=response_format or openai.NOT_GIVEN
+        )
+
+    async def get_run_status(self):
+        # Check the Run status
+        return await self.client.beta.threads.runs.retrieve(
+            thread_id=self.thread.id,
+            run_id=self.run.id
+        )
+
+    async def get_last_k_message(self, num):
+        messages = await self.client.beta.threads.messages.list(
+            thread_id=self.thread.id,
+            limit = num
+        )
+        return messages
+
+    async def poll_run(self, deadline=None):
+        # poll with a short interval at first, and grow the interval for the long runs
+        interval = self.poll_interval
+        if deadline is None:
+            deadline = self.run_start + self.timeout
+        while True:
+            run = await self.get_run_status()
+            if run.status in TERMINAL_RUN_STATUSES:
+                self.run = run
+                return run
+            if time.time() + interval > deadline:
+                print('polling time out in %.2f seconds' % (time.time() - self.run_start))
+                return None
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+
+    async def wait_run_completion(self):
+        try:
+            run = await self.poll_run()
+        except BaseException:
+            # the task waiting for the run is cancelled (i.e, by asyncio.wait_for), do not leave the run active
+            await asyncio.shield(self.cancel_run())
+            raise
+        if run is None:
+            # the run is abandoned, it would keep consuming tokens and block the thread
+            await self.cancel_run()
+            return None
+
+        wait_seconds = time.time() - self.run_start
+        run_seconds = None
+        # the expires_at of a run is its deadline, not when it finished, an expired run has no finish time,
+        # incomplete_at is missing from the older SDKs
+        finished_at = run.completed_at or run.failed_at or run.cancelled_at \
+                or getattr(run, 'incomplete_at', None)
+        if (run.created_at != None) and (finished_at != None):
+            run_seconds = finished_at - run.created_at
+        self.run_timing = {'run_seconds': run_seconds, 'wait_seconds': wait_seconds}
+        print('run %s, run took %s seconds, we waited %.2f seconds' % (run.status, run_seconds, wait_seconds))
+        self.record_usage(run)
+        return run
+
+    def record_usage(self, run):
+        # capture the usage when the run finishes
+        self.last_usage = usage_to_dict(run.usage)
+        if self.scheduler is not None:
+            self.scheduler.settle(self.run_estimate, self.last_usage['total_tokens'])
+            self.run_estimate = 0
+        if self.ledger is not None:
+            self.ledger.record(self.stage, self.last_usage, run.id)
+
+    async def cancel_run(self):
+        # cancel the active run, return the final run or None if it is not cancelled in cancel_timeout
+        if (self.run is None) or (self.run.status in TERMINAL_RUN_STATUSES):
+            return self.run
+        print('cancel run %s' % self.run.id)
+        try:
+            await self.client.beta.threads.runs.cancel(
+                thread_id=self.thread.id,
+                run_id=self.run.id
+            )
+        except openai.BadRequestError:
+            # the run reached a terminal status before the cancel request
+            pass
+        # the run goes through 'cancelling', the thread stays locked until it is 'cancelled'
+        run = await self.poll_run(time.time() + self.cancel_timeout)
+        if run is not None:
+            # the tokens consumed before the cancellation are billed too
+            self.record_usage(run)
+        return run
+
+    async def wait_thread_writable(self):
+        # a thread with an active run rejects new messages and runs, the previous run was abandoned by its caller
+        if (self.run is not None) and (self.run.status not in TERMINAL_RUN_STATUSES):
+            if await self.cancel_run() is None:
+                print('run %s is still active on thread %s' % (self.run.id, self.thread.id))
+
+    async def wait_get_last_k_message(self, num=1):
+        # wait and get the last message
+        run = await self.wait_run_completion()
+        return await self.get_run_messages(run, num)
+
+    async def get_run_messages(self, run, num):
+        if run is None:
+            return None
+        elif run.status == 'completed':
+            return await self.get_last_k_message(num)
+        else:
+            print('run %s' % run.status)
+            return None
+
+    async def ask(self, content, num=1, instructions=None, response_format=None):
+        # add the message, run the assistant and wait for the response,
+        # the limiter bounds the number of runs in flight across all assistants sharing it
+        async with self.run_limiter:
+            await self.add_message(content)
+            if self.scheduler is None:
+                await self.run_assistant(instructions, response_format)
+                return await self.wait_get_last_k_message(num)
+            estimate = self.scheduler.estimate_tokens([instructions or self.assistant.instructions, content])
+            try:
+                await self.submit_run(estimate, instructions, response_format)
+                run = await self.wait_run_completion()
+                # a run failed by the rate limit is run again after the scheduler backs off
+                attempt = 0
+                while (run is not None) and is_rate_limited_run(run) and (attempt < self.scheduler.max_retries):
+                    self.scheduler.backoff(attempt)
+                    attempt += 1
+                    await self.submit_run(estimate, instructions, response_format)
+                    run = await self.wait_run_completion()
+                return await self.get_run_messages(run, num)
+            finally:
+                # the run never reported its usage (i.e, the task is cancelled), give its budget back
+                self.refund_budget()
+
+    async def submit_run(self, estimate, instructions=None, response_format=None):
+        # the async counterpart of LLMScheduler.submit, back off and retry when the run is refused with 429
+        for attempt in range(self.scheduler.max_retries + 1):
+            await self.acquire_budget(estimate)
+            try:
+                await self.run_assistant(instructions, response_format)
+                return
+            except openai.RateLimitError as e:
+                # the run was not created, it consumes no tokens
+                self.refund_budget()
+                if attempt == self.scheduler.max_retries:
+                    raise
+                self.scheduler.backoff(attempt, retry_after_seconds(e))
+
+    async def acquire_budget(self, estimate):
+        # the scheduler is shared with the blocking assistants, wait for the budget in a worker thread,
+        # the worker cannot be interrupted, if the task is cancelled the budget is given back once it is acquired
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.scheduler.acquire, self.stage, estimate))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            def refund(future):
+                if not future.cancelled() and (future.exception() is None):
+                    self.scheduler.settle(estimate, 0)
+            acquiring.add_done_callback(refund)
+            raise
+        self.run_estimate = estimate
+
+    def refund_budget(self):
+        if self.run_estimate:
+            self.scheduler.settle(self.run_estimate, 0)
+            self.run_estimate = 0
+
+    async def get_token_usage(self, tmin, tmax, limit=20):
+        # get the token usage in [tmin, tmax)
+        runs = self.client.beta.threads.runs.list(
+                thread_id = self.thread.id,
+                order = 'desc',
+                limit = limit,
+                )
+
+        token_usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+
+        async for run in runs:
+            if (run.created_at != None) and (run.completed_at != None) and \
+                (run.created_at >= tmin) and (run.created_at < tmax) and \
+                (run.completed_at >= tmin) and (run.completed_at < tmax):
+                usage = usage_to_dict(run.usage)
+                token_usage['prompt_tokens'] += usage['prompt_tokens']
+                token_usage['completion_tokens'] += usage['completion_tokens']
+                token_usage['total_tokens'] += usage['total_tokens']
+
+        return token_usage
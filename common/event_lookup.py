@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+from common.neo4j_schema import EVENT_MESSAGE_FULLTEXT_INDEX
+
+
+# how the EVENT of an error message is found, shared by find_srcKind and the statepath queries:
+# 'contains' scans the EVENT messages (served by the TEXT index),
+# 'fulltext' finds the candidates by the exact phrase in the full-text index, CONTAINS confirms them
+EVENT_LOOKUPS = {
+    'contains': """MATCH ({alias}:EVENT)
+WHERE {alias}.message CONTAINS $message""",
+    'fulltext': """CALL db.index.fulltext.queryNodes($index, $phrase) YIELD node AS {alias}
+WHERE {alias}.message CONTAINS $message""",
+}
+
+
+# an exact phrase of the Lucene query syntax, only the quotes and backslashes need escaping inside the phrase
+def lucene_phrase(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# the query fragment binding the EVENT nodes of $message to alias
+def event_lookup(mode, alias):
+    if mode not in EVENT_LOOKUPS:
+        raise ValueError(f'unknown EVENT lookup mode {mode!r}')
+    return EVENT_LOOKUPS[mode].format(alias=alias)
+
+
+def event_lookup_parameters(message, mode):
+    if mode == 'fulltext':
+        return {'message': message, 'phrase': lucene_phrase(message), 'index': EVENT_MESSAGE_FULLTEXT_INDEX}
+    return {'message': message}
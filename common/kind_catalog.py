@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import functools
+
+
+NATIVE_EXTERNAL_KINDS_QUERY = """
+    MATCH (n1)
+    WHERE n1.category IN ['NativeEntity', 'ExternalEntity']
+    RETURN n1.category AS category, n1.kind AS kind
+    """
+
+# the version stamp of the metagraph, a single node outside of the schema graph (no kind, no relationship),
+# the loader of the metagraph bumps it with stamp_metagraph_version after every load
+METAGRAPH_VERSION_LABEL = 'MetagraphVersion'
+
+METAGRAPH_VERSION_QUERY = f"""
+    MATCH (v:{METAGRAPH_VERSION_LABEL})
+    RETURN v.version AS version
+    """
+
+# answered from the count store, they read no node and no relationship,
+# they catch the loads that did not bump the stamp, as long as they add or remove elements
+METAGRAPH_NODE_COUNT_QUERY = """
+    MATCH (n)
+    RETURN count(n) AS count
+    """
+
+METAGRAPH_RELATIONSHIP_COUNT_QUERY = """
+    MATCH ()-[r]->()
+    RETURN count(r) AS count
+    """
+
+
+def split_native_external_kinds(records):
+    nativeKinds = sorted([x['kind'] for x in records if (x['category'] == 'NativeEntity')])
+    externalKinds = sorted([x['kind'] for x in records if (x['category'] == 'ExternalEntity')])
+    return nativeKinds, externalKinds
+
+
+def stamp_metagraph_version(query_executor):
+    # call it once the metagraph is (re)loaded, the kind catalog and the metapath index are then rebuilt
+    records = query_executor.run_write_query(f"""
+        MERGE (v:{METAGRAPH_VERSION_LABEL})
+        SET v.version = randomUUID(), v.stamped_at = datetime()
+        RETURN v.version AS version
+        """)
+    return records[0]['version']
+
+
+def metagraph_fingerprint(query_executor):
+    # the version stamp and the element counts, a cheap freshness check that does not read the metagraph
+    records = query_executor.run_query(METAGRAPH_VERSION_QUERY)
+    version = records[0]['version'] if records else None
+    nodes = query_executor.run_query(METAGRAPH_NODE_COUNT_QUERY)[0]['count']
+    relationships = query_executor.run_query(METAGRAPH_RELATIONSHIP_COUNT_QUERY)[0]['count']
+    content = json.dumps([version, nodes, relationships])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+# the property holding the name of an entity, it depends on the kind facts of the entity only
+@functools.lru_cache(maxsize=None)
+def name_key(isNative, isAtomic, tag):
+    if isNative == 'true':
+        return 'name2'
+    elif isAtomic == 'true':
+        return 'val'
+    elif tag in ['nfs', 'hostPath']:
+        return 'path'
+    elif tag == 'container':
+        return 'containerName'
+    elif tag == 'image':
+        return 'imageName'
+    raise ValueError(f'no name key for the entity (isNative={isNative}, isAtomic={isAtomic}, tag={tag})')
+
+
+def entity_name_key(entity):
+    return name_key(entity['isNative'], entity.get('isAtomic'), entity.get('tag'))
+
+
+def entity_kind_key(entity):
+    # the property holding the kind of an entity, as it appears in the messages
+    return 'kind2' if entity['isNative'] == 'true' else 'tag'
+
+
+# the native and external kinds of the metagraph, loaded once and cached on disk with the fingerprint of the
+# metagraph, so a new process reads them from disk unless the metagraph changed
+class KindCatalog:
+    def __init__(self, nativeKinds, externalKinds, fingerprint=None):
+        # the sorted lists go into the prompt template, the sets answer the membership
+        self.nativeKinds = sorted(nativeKinds)
+        self.externalKinds = sorted(externalKinds)
+        self.native = frozenset(nativeKinds)
+        self.external = frozenset(externalKinds)
+        self.kinds = self.native | self.external
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def scan(cls, query_executor, fingerprint=None):
+        records = query_executor.run_query(NATIVE_EXTERNAL_KINDS_QUERY, stage='kinds')
+        return cls(*split_native_external_kinds(records), fingerprint)
+
+    # fingerprint: the metagraph_fingerprint if the caller has it already, so it is not queried again
+    @classmethod
+    def load(cls, query_executor, path='./cache/kind_catalog.json', fingerprint=None):
+        fingerprint = fingerprint or metagraph_fingerprint(query_executor)
+        if os.path.exists(path):
+            with open(path) as f:
+                cached = json.load(f)
+            if cached.get('fingerprint') == fingerprint:
+                return cls(cached['nativeKinds'], cached['externalKinds'], fingerprint)
+        print('scan the kinds of the metagraph %s' % fingerprint[:12])
+        catalog = cls.scan(query_executor, fingerprint)
+        catalog.save(path)
+        return catalog
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'nativeKinds': self.nativeKinds,
+                       'externalKinds': self.externalKinds}, f, indent=4)
+        os.replace(tmp_path, path)
+
+    def is_fresh(self, query_executor):
+        return self.fingerprint == metagraph_fingerprint(query_executor)
+
+    def __contains__(self, kind):
+        return kind in self.kinds
+
+    def is_native(self, kind):
+        return kind in self.native
+
+    def is_external(self, kind):
+        return kind in self.external
+
+    entity_name_key = staticmethod(entity_name_key)
+    entity_kind_key = staticmethod(entity_kind_key)
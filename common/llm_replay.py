@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+
+import os
+import json
+import time
+from types import SimpleNamespace
+
+from common.openai_chat_assistant import OpenAIChatAssistant
+
+
+# a fixture file with the responses, usage and latency of real runs, keyed by the request fingerprint,
+# the same request can be answered differently (i.e, a retry), so every key keeps its responses in order
+class LLMRecording:
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        # whether the assistant of a stage was stateless when recorded, the replay must build the same prompts
+        self.stateless = dict()
+        self.cursors = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                fixture = json.load(f)
+            if fixture.get('version') != self.VERSION:
+                raise ValueError(f'{path} is a version {fixture.get("version")} recording, expect version {self.VERSION}')
+            self.entries = fixture['entries']
+            self.stateless = fixture['stateless']
+
+    def record(self, stage, stateless, key, response, usage, latency):
+        self.stateless[stage] = stateless
+        self.entries.setdefault(key, []).append({'stage': stage, 'response': response,
+                                                 'usage': usage, 'latency': latency})
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fixture = {'version': self.VERSION, 'stateless': self.stateless, 'entries': self.entries}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fixture, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def next(self, key):
+        # the i-th request with the same key gets the i-th recorded response, the last one is repeated
+        if key not in self.entries:
+            raise LookupError(f'no recorded response for request {key}, record it again with the live backend')
+        responses = self.entries[key]
+        cursor = self.cursors.get(key, 0)
+        self.cursors[key] = cursor + 1
+        return responses[min(cursor, len(responses) - 1)]
+
+    def rewind(self):
+        self.cursors = dict()
+
+
+# answer from an LLMRecording instead of the API, deterministic and offline,
+# so the Neo4j and orchestration hot paths can be profiled without network access or token cost
+class OpenAIReplayAssistant(OpenAIChatAssistant):
+    # simulate_latency: sleep for the recorded latency of every run, to replay the wall-clock shape of a real run
+    def __init__(self, recording, simulate_latency=False, **kwargs):
+        super().__init__(recording=recording, **kwargs)
+        self.simulate_latency = simulate_latency
+        self.stateless = recording.stateless.get(self.stage, False)
+
+    def create_client(self):
+        # no client, no API key and no network
+        return None
+
+    def retrieve_assistant(self, assistant_id):
+        # the recording keeps the responses, not the Assistants, there is no server to retrieve one from
+        raise ValueError(f'can not retrieve assistant {assistant_id} in replay, '
+                         'create the assistant with the instructions and model it was recorded with')
+
+    def record_response(self, text, latency):
+        # never record the replayed responses again, only follow the thread history as the live backend did
+        self.extend_thread_digest(text)
+
+    def start_run(self, instructions=None):
+        entry = self.recording.next(self.cache_key)
+        if self.simulate_latency:
+            time.sleep(entry['latency'])
+        created_at = int(time.time())
+        self.run = SimpleNamespace(id=f'replay-{self.cache_key[:12]}', status='completed', usage=entry['usage'],
+                                   created_at=created_at, completed_at=created_at)
+        self.runs.append(self.run)
+        self.responses.insert(0, entry['response'])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+
+import os
+import json
+import time
+import hashlib
+
+
+# the prompts are built with indented triple-quoted strings, ignore the whitespace layout
+def normalize_prompt(text):
+    return ' '.join(text.split())
+
+
+# identify an LLM request by the model, the instructions and the normalized prompt
+def request_fingerprint(model, instructions, prompt):
+    content = '\x00'.join([model or '', normalize_prompt(instructions or ''), normalize_prompt(prompt)])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+# a content-addressed cache for the LLM responses, one JSON file per request fingerprint,
+# so re-running the same CSV (or seeing the same incident again) skips the runs of byte-identical requests
+class LLMResponseCache:
+    # max_entries: the oldest entries are evicted once the cache holds more entries
+    # max_age: entries older than max_age seconds are treated as missing and removed
+    # bypass: do not answer from the cache, but still store the fresh responses (i.e, to refresh a regression run)
+    # evict_interval: the expired entries are removed at most once per evict_interval seconds,
+    # the directory is scanned only then, or when the cache grows beyond max_entries
+    def __init__(self, cache_dir='./cache/llm_responses', max_entries=10000, max_age=30*24*3600, bypass=False,
+                 evict_interval=3600):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.bypass = bypass
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # scan once at startup, then keep the count of entries in memory
+        self.evict()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        if self.bypass:
+            self.bypassed += 1
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - entry['created_at'] > self.max_age:
+            os.remove(path)
+            self.entry_count -= 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['response']
+
+    def put(self, key, response):
+        entry = {'created_at': time.time(), 'response': response}
+        # write to a temporary file and rename it, so a concurrent reader never sees a partial entry
+        tmp_path = self.entry_path(key) + '.tmp'
+        is_new = not os.path.exists(self.entry_path(key))
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.entry_path(key))
+        if is_new:
+            self.entry_count += 1
+        if (self.entry_count > self.max_entries) or (time.time() - self.last_evict > self.evict_interval):
+            self.evict()
+
+    def evict(self):
+        # remove the expired entries, then the oldest ones beyond max_entries,
+        # down to 90% of max_entries, so the next writes do not scan the directory again right away
+        self.last_evict = time.time()
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            mtime = os.path.getmtime(path)
+            if now - mtime > self.max_age:
+                os.remove(path)
+            else:
+                entries.append((mtime, path))
+        if len(entries) > self.max_entries:
+            keep = int(self.max_entries * 0.9)
+            entries.sort()
+            for mtime, path in entries[:len(entries) - keep]:
+                os.remove(path)
+            entries = entries[len(entries) - keep:]
+        self.entry_count = len(entries)
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, name))
+        self.entry_count = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
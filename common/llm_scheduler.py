@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+
+import time
+import heapq
+import random
+import itertools
+import threading
+import openai
+
+
+# the earlier stages unblock the later ones, so they go first when the budget is short
+STAGE_PRIORITY = {'locator': 0, 'cypher': 1, 'semantic': 2}
+
+
+# the retry-after header of a 429 response, if the provider sent one
+def retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+# a failed run caused by the rate limit, instead of a failed request
+def is_rate_limited_run(run):
+    last_error = getattr(run, 'last_error', None)
+    return (run.status == 'failed') and (last_error is not None) and (last_error.code == 'rate_limit_exceeded')
+
+
+# one scheduler shared by all assistants, it keeps the requests within the account limits:
+# two token buckets (requests per minute and tokens per minute), the waiting requests are served by stage priority,
+# and a 429 pauses every assistant for an exponential backoff instead of failing the following requests too
+class LLMScheduler:
+    def __init__(self, requests_per_minute=500, tokens_per_minute=40000, max_retries=5,
+                 base_backoff=1, max_backoff=60, completion_reserve=500):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_bucket = requests_per_minute
+        self.token_bucket = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # the tokens we expect a completion to take, added to the estimated prompt tokens
+        self.completion_reserve = completion_reserve
+        self.last_refill = time.time()
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+        self.stats = {'requests': 0, 'rate_limited': 0, 'wait_seconds': 0.0}
+
+    def estimate_tokens(self, texts):
+        # about 4 characters per token for English text
+        return sum(len(text) for text in texts if text) // 4 + self.completion_reserve
+
+    def refill(self):
+        now = time.time()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_bucket = min(self.request_capacity, self.request_bucket + elapsed * self.request_rate)
+        self.token_bucket = min(self.token_capacity, self.token_bucket + elapsed * self.token_rate)
+
+    def time_until_ready(self, tokens):
+        # a request larger than the whole budget waits for a full bucket
+        tokens = min(tokens, self.token_capacity)
+        request_wait = max(0, 1 - self.request_bucket) / self.request_rate
+        token_wait = max(0, tokens - self.token_bucket) / self.token_rate
+        pause_wait = max(0, self.paused_until - time.time())
+        return max(request_wait, token_wait, pause_wait)
+
+    def acquire(self, stage, tokens):
+        # block until the budget allows the request and no request with a higher priority is waiting
+        start = time.time()
+        ticket = (STAGE_PRIORITY.get(stage, len(STAGE_PRIORITY)), next(self.counter))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                self.refill()
+                wait = self.time_until_ready(tokens)
+                if (self.waiting[0] == ticket) and (wait <= 0):
+                    heapq.heappop(self.waiting)
+                    self.request_bucket -= 1
+                    self.token_bucket -= tokens
+                    self.stats['requests'] += 1
+                    self.stats['wait_seconds'] += time.time() - start
+                    self.condition.notify_all()
+                    return
+                self.condition.wait(timeout=min(max(wait, 0.05), 1))
+
+    def settle(self, estimated_tokens, actual_tokens):
+        # correct the token bucket once the run reports its real usage
+        with self.condition:
+            self.token_bucket -= actual_tokens - estimated_tokens
+            self.condition.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        # pause all the assistants, the provider counts the limit per account
+        delay = retry_after
+        if delay is None:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** attempt)) * random.uniform(0.5, 1)
+        print('rate limited, back off %.2f seconds' % delay)
+        with self.condition:
+            self.stats['rate_limited'] += 1
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            self.condition.notify_all()
+
+    def submit(self, stage, tokens, request):
+        # run the request within the budget, back off and retry on 429
+        for attempt in range(self.max_retries + 1):
+            self.acquire(stage, tokens)
+            try:
+                return request()
+            except openai.RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                self.backoff(attempt, retry_after_seconds(e))
@@ -1,25 +1,150 @@
 #!/usr/bin/env python
 
-from neo4j import GraphDatabase
+import time
+import threading
+import collections
+from contextlib import contextmanager, closing
+from neo4j import GraphDatabase, READ_ACCESS
+
+from common.query_profiler import total_db_hits
 
 # Define a class for interacting with Neo4j
 class Neo4jQueryExecutor:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    # max_connection_pool_size: the most connections the driver keeps open to the server
+    # connection_acquisition_timeout: the longest time (in seconds) a query waits for a free connection
+    # fetch_size: the number of records pulled from the server in one batch
+    # database: the database to query, None for the home database of the user
+    # profiler: a QueryProfiler, the timing, record count (and db hits) of every query are recorded into it by stage
+    def __init__(self, uri, user, password, max_connection_pool_size=50, connection_acquisition_timeout=60,
+                 fetch_size=1000, database=None, profiler=None):
+        self.driver = GraphDatabase.driver(uri, auth=(user, password),
+                                           max_connection_pool_size=max_connection_pool_size,
+                                           connection_acquisition_timeout=connection_acquisition_timeout)
         self.driver.verify_connectivity()
+        self.fetch_size = fetch_size
+        self.database = database
+        self.profiler = profiler
+        # how many times each query text is run, see repeated_query_stats
+        self.query_counts = collections.Counter()
+        # the session of the current session_scope, per thread, a session must not be shared between threads
+        self.local = threading.local()
 
     def close(self):
         # Close the connection to the database
         self.driver.close()
 
-    def run_query(self, query, parameters=None):
-        with self.driver.session() as session:
-            # Run the query and immediately consume the results
-            result = session.run(query, parameters)
+    def new_session(self, fetch_size=None):
+        # every query of the pipeline is a read, so the session is opened in read mode
+        return self.driver.session(database=self.database, fetch_size=fetch_size or self.fetch_size,
+                                   default_access_mode=READ_ACCESS)
+
+    @contextmanager
+    def session_scope(self):
+        # run a group of queries on one session instead of opening a session per query,
+        # the nested scopes (and the run_query calls inside) share the session of the outermost scope
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            yield session
+            return
+        session = self.new_session()
+        self.local.session = session
+        try:
+            yield session
+        finally:
+            self.local.session = None
+            session.close()
+
+    @staticmethod
+    def read_records(tx, query, parameters):
+        # the records must be consumed before the transaction ends, the summary carries the server timings
+        result = tx.run(query, parameters)
+        records = list(result)
+        return records, result.consume()
+
+    def profile_query(self, query, stage):
+        # PROFILE counts the db hits of every operator, only the labeled queries of the pipeline are profiled,
+        # the others (i.e, SHOW INDEXES) can not be
+        if (self.profiler is not None) and self.profiler.profile_db_hits and (stage is not None):
+            return 'PROFILE ' + query
+        return query
+
+    def record_profile(self, stage, query, start, summary, records):
+        if self.profiler is None:
+            return
+        wall_ms = (time.time() - start) * 1000
+        if summary is None:
+            self.profiler.record(stage, query, wall_ms, records=records)
+        else:
+            self.profiler.record(stage, query, wall_ms, summary.result_available_after, summary.result_consumed_after,
+                                 records, total_db_hits(summary.profile))
+
+    # stage labels the query for the profiler, i.e, 'srcKind', 'metapath', 'statepath', 'state'
+    def run_query(self, query, parameters=None, stage=None):
+        # run the query in a managed read transaction, the driver retries it on transient errors
+        # (i.e, a leader switch or a deadlock), then return the list of records
+        self.query_counts[query] += 1
+        start = time.time()
+        with self.session_scope() as session:
+            records, summary = session.execute_read(self.read_records, self.profile_query(query, stage), parameters)
+        self.record_profile(stage, query, start, summary, len(records))
+        return records
+
+    def run_write_query(self, query, parameters=None):
+        # the few writes (i.e, the schema bootstrap) run in auto-commit mode on a write session
+        with self.driver.session(database=self.database) as session:
+            return list(session.run(query, parameters))
+
+    def explain(self, query, parameters=None):
+        # the plan of the query without running it, a dict of operatorType, args and children
+        with self.session_scope() as session:
+            return session.run('EXPLAIN ' + query, parameters).consume().plan
 
-            # Convert the result to a list so we can iterate multiple times if needed
-            records = list(result)
+    def stream_query(self, query, parameters=None, fetch_size=None, stage=None):
+        # yield the records as they are pulled from the server, fetch_size records per batch, instead of a full list,
+        # the query runs in an explicit read transaction without retries, since the records may have been used already,
+        # closing the generator early discards the remaining records on the server
+        # Note: inside a session_scope, run no other query on the scope until the generator is exhausted or closed
+        # the profiled wall time includes the time the caller spends on the records,
+        # the server timings are only known when all records are pulled
+        self.query_counts[query] += 1
+        session = getattr(self.local, 'session', None)
+        own_session = (session is None) or (fetch_size is not None)
+        if own_session:
+            session = self.new_session(fetch_size)
+        start = time.time()
+        summary = None
+        count = 0
+        try:
+            with session.begin_transaction() as tx:
+                result = tx.run(self.profile_query(query, stage), parameters)
+                for record in result:
+                    count += 1
+                    yield record
+                summary = result.consume()
+        finally:
+            self.record_profile(stage, query, start, summary, count)
+            if own_session:
+                session.close()
 
-            # You can now return the list of records, process it here, or both
-            return records
+    def find_first_n(self, query, parameters=None, n=1, predicate=None, fetch_size=None, stage=None):
+        # the first n records that satisfy the predicate (any record without a predicate),
+        # stop pulling records from the server as soon as we have them
+        matched = []
+        if n <= 0:
+            return matched
+        with closing(self.stream_query(query, parameters, fetch_size, stage)) as records:
+            for record in records:
+                if (predicate is None) or predicate(record):
+                    matched.append(record)
+                    if len(matched) == n:
+                        break
+        return matched
 
+    def repeated_query_stats(self):
+        # the share of the queries whose text was run before, counted on the client,
+        # the values of a parameterized query do not change its text, so a repeated text can reuse the plan
+        # Neo4j cached for it, whether it did (or the plan was evicted) is only known from the server metrics
+        queries = sum(self.query_counts.values())
+        distinct = len(self.query_counts)
+        return {'queries': queries, 'distinct_queries': distinct,
+                'repeated_text_ratio': (queries - distinct) / queries if queries else 0.0}
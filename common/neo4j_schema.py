@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import re
+
+
+# an index the hot queries need, serves tells which queries use it
+class IndexSpec:
+    # index_type: 'RANGE', 'TEXT' or 'FULLTEXT'
+    # entity_type: 'NODE' or 'RELATIONSHIP'
+    # name: the index name, derived from the label and properties by default
+    def __init__(self, index_type, entity_type, label, properties, serves, name=None):
+        self.index_type = index_type
+        self.entity_type = entity_type
+        self.label = label
+        self.properties = list(properties)
+        self.serves = serves
+        self.name = name or re.sub(r'\W', '_', '_'.join([label] + self.properties + [index_type])).lower()
+
+    def signature(self):
+        # an existing index with the same signature serves the queries, whatever its name is
+        return (self.index_type, self.entity_type, (self.label,), tuple(self.properties))
+
+    def create_statement(self):
+        if self.entity_type == 'NODE':
+            pattern = f'(n:`{self.label}`)'
+        else:
+            pattern = f'()-[n:`{self.label}`]-()'
+        properties = ', '.join(f'n.{p}' for p in self.properties)
+        if self.index_type == 'FULLTEXT':
+            return f'CREATE FULLTEXT INDEX {self.name} IF NOT EXISTS FOR {pattern} ON EACH [{properties}]'
+        prefix = 'CREATE TEXT INDEX' if self.index_type == 'TEXT' else 'CREATE INDEX'
+        return f'{prefix} {self.name} IF NOT EXISTS FOR {pattern} ON ({properties})'
+
+    def __repr__(self):
+        return f'{self.index_type} INDEX {self.name} ON {self.label}({", ".join(self.properties)})'
+
+
+# the name of the full-text index on the messages of the EVENT nodes
+EVENT_MESSAGE_FULLTEXT_INDEX = 'event_message_fulltext'
+
+# the indexes of the stategraph that do not depend on the kinds,
+# the statepath queries start from the EVENT of the error message, the state queries from the entity by id,
+# the tmin/tmax of HasState are filtered after the expand from the entity, no relationship index serves them,
+# the kind / kind2 filters are on the metagraph only (see bootstrap_schema), the stategraph is matched by label
+STATEGRAPH_INDEXES = [
+    IndexSpec('TEXT', 'NODE', 'EVENT', ['message'],
+              "find_srcKind, the statepath queries in 'contains' mode (EVENT.message CONTAINS $message)"),
+    IndexSpec('FULLTEXT', 'NODE', 'EVENT', ['message'],
+              "find_srcKind, the statepath queries in 'fulltext' mode (db.index.fulltext.queryNodes)",
+              EVENT_MESSAGE_FULLTEXT_INDEX),
+]
+
+# the relationships without a key, HasState links an entity to its STATE nodes
+UNKEYED_RELATIONSHIP_TYPES = ['HasState']
+
+# the plan operators that read every node (of a label), a hot query should not need them
+FULL_SCAN_OPERATORS = ['AllNodesScan', 'NodeByLabelScan', 'DirectedAllRelationshipsScan',
+                       'UndirectedAllRelationshipsScan']
+
+
+def find_labels(query_executor):
+    records = query_executor.run_query('CALL db.labels() YIELD label RETURN label')
+    return sorted(record['label'] for record in records)
+
+
+def find_relationship_types(query_executor):
+    records = query_executor.run_query('CALL db.relationshipTypes() YIELD relationshipType RETURN relationshipType')
+    return sorted(record['relationshipType'] for record in records)
+
+
+def stategraph_index_specs(query_executor):
+    # the labels and relationship types follow the kinds, so they are found at startup
+    specs = list(STATEGRAPH_INDEXES)
+    labels = find_labels(query_executor)
+    # the Event is reached from its EVENT, the STATE nodes (the upper case of an entity label) from their entity
+    state_labels = {label.upper() for label in labels if label.upper() != label}
+    for label in labels:
+        if (label in ['Event', 'EVENT']) or (label in state_labels):
+            continue
+        specs.append(IndexSpec('RANGE', 'NODE', label, ['id'],
+                               'find_strict_states, find_loose_states, find_entity, find_batched_states (n1.id)'))
+    for relType in find_relationship_types(query_executor):
+        if relType in UNKEYED_RELATIONSHIP_TYPES:
+            continue
+        serves = 'the statepath queries (r.key = $keys[i])'
+        if relType == 'ReferInternal':
+            serves = "find_srcKind (r1.key = 'involvedObject_uid'), " + serves
+        specs.append(IndexSpec('RANGE', 'RELATIONSHIP', relType, ['key'], serves))
+    return specs
+
+
+def existing_index_signatures(query_executor):
+    records = query_executor.run_query(
+        'SHOW INDEXES YIELD name, type, entityType, labelsOrTypes, properties '
+        'RETURN name, type, entityType, labelsOrTypes, properties')
+    signatures = dict()
+    for record in records:
+        if record['labelsOrTypes'] is None:
+            # the token lookup indexes, they serve the label scans only
+            continue
+        signature = (record['type'], record['entityType'], tuple(record['labelsOrTypes']), tuple(record['properties']))
+        signatures[signature] = record['name']
+    return signatures
+
+
+def ensure_indexes(query_executor, specs, graph_name=''):
+    # create the missing indexes and report which queries every index serves, return the created ones
+    existing = existing_index_signatures(query_executor)
+    created = []
+    for spec in specs:
+        if spec.signature() in existing:
+            print(f'[{graph_name}] {spec} exists as {existing[spec.signature()]}, serves {spec.serves}')
+            continue
+        query_executor.run_write_query(spec.create_statement())
+        created.append(spec)
+        print(f'[{graph_name}] {spec} created, serves {spec.serves}')
+    # the new indexes are populated in the background, the queries use them once they are online
+    if created:
+        query_executor.run_write_query('CALL db.awaitIndexes(300)')
+    return created
+
+
+def find_full_scans(plan):
+    # the full scan operators in the plan tree (the operator type may end with @<database>)
+    scans = []
+    operator = plan['operatorType'].split('@')[0]
+    if operator in FULL_SCAN_OPERATORS:
+        scans.append(operator + ' ' + str(plan['args'].get('Details', '')))
+    for child in plan.get('children', []):
+        scans += find_full_scans(child)
+    return scans
+
+
+def check_query_plans(query_executor, queries, graph_name=''):
+    # queries: a dict of name -> (query, parameters), warn for every query whose plan still scans
+    warnings = dict()
+    for name, (query, parameters) in queries.items():
+        scans = find_full_scans(query_executor.explain(query, parameters))
+        if scans:
+            warnings[name] = scans
+            print(f'[{graph_name}] Warning: the plan of {name} still has a full scan: {"; ".join(scans)}')
+    return warnings
+
+
+# make sure the indexes of the stategraph exist, then check the plans of the hot queries of both graphs,
+# metagraph_queries / stategraph_queries are dicts of name -> (query, parameters)
+# the metagraph has no index: its queries match unlabeled nodes, which no label-scoped index serves,
+# and it is small and static, so it is read once (see KindCatalog, MetaGraph) rather than queried per message
+def bootstrap_schema(metagraph_query_executor, stategraph_query_executor, metagraph_queries=None,
+                     stategraph_queries=None):
+    ensure_indexes(stategraph_query_executor, stategraph_index_specs(stategraph_query_executor), 'stategraph')
+    warnings = dict()
+    warnings.update(check_query_plans(metagraph_query_executor, metagraph_queries or dict(), 'metagraph'))
+    warnings.update(check_query_plans(stategraph_query_executor, stategraph_queries or dict(), 'stategraph'))
+    return warnings
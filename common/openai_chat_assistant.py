@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+
+import time
+import openai
+from types import SimpleNamespace
+
+from common.openai_generic_assistant import OpenAIGenericAssistant, build_text_messages
+
+
+# a stateless backend with the same surface as OpenAIGenericAssistant
+# every run sends only the system instructions and the messages added since the last run
+# through one chat completion, so the cost of a message does not grow with the number of messages processed
+class OpenAIChatAssistant(OpenAIGenericAssistant):
+    stateless = True
+
+    def create_assistant(self, instructions, name, model='gpt-4'):
+        # nothing to create on the server, keep the assistant locally
+        self.assistant = SimpleNamespace(id=f'chat-{name}', name=name, instructions=instructions, model=model)
+
+    def retrieve_assistant(self, assistant_id):
+        # reuse the instructions and model of an existing Assistant
+        self.assistant = self.client.beta.assistants.retrieve(assistant_id)
+
+    def create_thread(self):
+        # the "thread" only holds the pending messages of the current request
+        self.thread = SimpleNamespace(id='stateless')
+        self.pending = []
+        self.thread_digest = ''
+        self.runs = []
+        self.responses = []
+
+    def retrieve_thread(self, thread_id):
+        # there is no thread to retrieve on the server
+        self.create_thread()
+
+    def add_message(self, content):
+        self.pending.append(content)
+
+    def add_cached_response(self, text):
+        self.responses.insert(0, text)
+
+    def start_run(self, instructions=None):
+        messages = [{'role': 'system', 'content': instructions or self.assistant.instructions}]
+        messages += [{'role': 'user', 'content': content} for content in self.run_messages]
+
+        created_at = int(time.time())
+        completion = self.client.chat.completions.create(
+            model=self.assistant.model,
+            messages=messages,
+            response_format=self.run_response_format or openai.NOT_GIVEN,
+            timeout=self.timeout
+        )
+        usage = {'prompt_tokens': completion.usage.prompt_tokens,
+                 'completion_tokens': completion.usage.completion_tokens,
+                 'total_tokens': completion.usage.total_tokens}
+        self.run = SimpleNamespace(id=completion.id, status='completed', usage=usage,
+                                   created_at=created_at, completed_at=int(time.time()))
+        self.runs.append(self.run)
+        self.responses.insert(0, completion.choices[0].message.content)
+
+    def get_run_status(self):
+        return self.run
+
+    def wait_run_completion(self):
+        # the completion call already returned in run_assistant
+        wait_seconds = time.time() - self.run_start
+        self.run_timing = {'run_seconds': wait_seconds, 'wait_seconds': wait_seconds}
+        self.record_usage(self.run)
+        return self.run
+
+    def get_last_k_message(self, num):
+        return build_text_messages(self.responses[:num])
+
+    def get_last_message(self):
+        return self.get_last_k_message(1)
+
+    def get_all_message(self):
+        return self.get_last_k_message(len(self.responses))
+
+    def display_response(self):
+        print(self.responses[0])
+
+    def get_token_usage(self, tmin, tmax, limit=20):
+        # get the token usage in [tmin, tmax) from the runs kept locally
+        token_usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+
+        for run in self.runs[-limit:]:
+            if (run.created_at >= tmin) and (run.created_at < tmax) and \
+                (run.completed_at >= tmin) and (run.completed_at < tmax):
+                token_usage['prompt_tokens'] += run.usage['prompt_tokens']
+                token_usage['completion_tokens'] += run.usage['completion_tokens']
+                token_usage['total_tokens'] += run.usage['total_tokens']
+
+        return token_usage
@@ -2,18 +2,95 @@
 
 
 import os
+import json
 import openai
 from openai import OpenAI
 import time
+from types import SimpleNamespace
+
+from common.token_ledger import usage_to_dict
+from common.llm_scheduler import is_rate_limited_run
+from common.llm_response_cache import request_fingerprint
+
+
+# the run will not change anymore once it reaches one of these status
+TERMINAL_RUN_STATUSES = ['completed', 'cancelled', 'failed', 'expired', 'incomplete']
+
+# the stream events of a run reaching a terminal status, the thread.run.step.* events carry RunSteps, not the run
+TERMINAL_RUN_EVENTS = {'thread.run.' + status for status in TERMINAL_RUN_STATUSES}
+
+
+# wrap plain texts (latest first) in the shape of client.beta.threads.messages.list(),
+# so the callers can read messages.data[0].content[0].text.value whatever the backend is
+def build_text_messages(texts):
+    data = [SimpleNamespace(role='assistant', content=[SimpleNamespace(type='text', text=SimpleNamespace(value=text))])
+            for text in texts]
+    return SimpleNamespace(data=data)
+
+
+# a response_format that constrains the response to the JSON schema, see OpenAIGenericAssistant.run_assistant
+def json_schema_format(name, schema):
+    return {'type': 'json_schema', 'json_schema': {'name': name, 'schema': schema, 'strict': True}}
 
 
 class OpenAIGenericAssistant:
-    def __init__(self):
+    # the thread keeps the whole conversation, see OpenAIChatAssistant for the stateless backend
+    stateless = False
+
+    # completion_mode decides how we wait for a run:
+    # 'poll': poll the run status, start with poll_interval and grow it to max_poll_interval
+    # 'stream': create the run with stream=True and return on the terminal run event
+    # timeout is the longest time (in seconds) we wait for a run
+    # response_cache is an LLMResponseCache, byte-identical requests are answered from it without a run
+    # ledger is a TokenLedger, the usage of every finished run is recorded under stage (i.e, 'locator')
+    # scheduler is an LLMScheduler shared by all assistants, the runs are submitted through it by stage priority
+    # recording is an LLMRecording, the responses, usage and latency of the finished runs are recorded into it
+    # registry is an AssistantRegistry, an Assistant with the same name, instructions and model is reused
+    # structured_output: apply the response_format asked by the caller, the model must support it (i.e, gpt-4o)
+    # cancel_timeout is the longest time (in seconds) we wait for an abandoned run to be cancelled
+    def __init__(self, completion_mode='poll', poll_interval=0.5, max_poll_interval=5, timeout=600,
+                 response_cache=None, ledger=None, stage=None, scheduler=None, recording=None, registry=None,
+                 structured_output=False, cancel_timeout=30):
+        self.client = self.create_client()
+        self.completion_mode = completion_mode
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.cancel_timeout = cancel_timeout
+        self.run = None
+        self.run_stream = None
+        self.run_timing = None
+        self.response_cache = response_cache
+        self.cache_key = None
+        self.cached_response = None
+        self.pending = []
+        self.thread_digest = ''
+        self.ledger = ledger
+        self.stage = stage
+        self.last_usage = None
+        self.scheduler = scheduler
+        self.run_estimate = 0
+        self.recording = recording
+        self.registry = registry
+        self.registered_assistant = False
+        self.structured_output = structured_output
+        self.run_response_format = None
+
+    def create_client(self):
         # Initialize the OpenAI client with the API key from environment variable
         openai.api_key = os.getenv("OPENAI_API_KEY")
-        self.client = OpenAI()
+        return OpenAI()
 
     def create_assistant(self, instructions, name, model='gpt-4'):
+        # reuse the registered Assistant without any API call, its id is all a run needs
+        self.registered_assistant = False
+        if self.registry is not None:
+            assistant_id = self.registry.lookup(name, instructions, model)
+            if assistant_id is not None:
+                self.assistant = SimpleNamespace(id=assistant_id, name=name, instructions=instructions, model=model)
+                self.registered_assistant = True
+                return
+
         # Create an Assistant
         self.assistant = self.client.beta.assistants.create(
                 instructions=instructions,
@@ -21,6 +98,8 @@ class OpenAIGenericAssistant:
                 model=model,
                 #tools=[{"type": "code_interpreter"}]
         )
+        if self.registry is not None:
+            self.registry.register(name, instructions, model, self.assistant.id)
 
     def retrieve_assistant(self, assistant_id):
         # Retrive an existing Assistant
@@ -29,27 +108,113 @@ class OpenAIGenericAssistant:
     def create_thread(self):
         # Create a Thread
         self.thread = self.client.beta.threads.create()
+        self.run = None
+        self.pending = []
+        self.thread_digest = ''
 
     def retrieve_thread(self, thread_id):
         # Retrieve an existing Thread
         self.thread = self.client.beta.threads.retrieve(thread_id)
+        self.run = None
+        self.pending = []
+        # the history kept on the server is unknown, the runs on this thread are neither cached nor recorded
+        self.thread_digest = None
     
     def add_message(self, content):
         # Add a Message to a Thread
+        self.wait_thread_writable()
         self.message = self.client.beta.threads.messages.create(
             thread_id=self.thread.id,
             role="user",
             content=content
         )
+        # the messages added since the last run make up the request of the next run
+        self.pending.append(content)
+
+    # response_format is the structure the caller expects (i.e, from json_schema_format),
+    # it is applied only when the assistant is set up with structured_output
+    def run_assistant(self, instructions=None, response_format=None):
+        # Run the Assistant, or answer from the response cache if the same request was answered before
+        self.run_messages = self.pending
+        self.pending = []
+        self.cache_key = None
+        self.cached_response = None
+        self.run_response_format = response_format if self.structured_output else None
+        if ((self.response_cache is not None) or (self.recording is not None)) and (self.thread_digest is not None):
+            # the response format is a part of the context like the instructions (the rules and templates),
+            # and so is the history of the thread, the server answers from the whole thread unless stateless
+            context = instructions or self.assistant.instructions
+            if self.run_response_format is not None:
+                context += '\n' + json.dumps(self.run_response_format, sort_keys=True)
+            if not self.stateless:
+                context += '\n' + self.thread_digest
+            self.cache_key = request_fingerprint(self.assistant.model, context, '\n'.join(self.run_messages))
+        if (self.response_cache is not None) and (self.cache_key is not None):
+            self.cached_response = self.response_cache.get(self.cache_key)
+            if self.cached_response is not None:
+                print('answer from the response cache')
+                self.add_cached_response(self.cached_response)
+                self.record_usage(None, cached=True)
+                return
+        self.run_instructions = instructions
+        self.submit_run(instructions)
+
+    def submit_run(self, instructions=None):
+        # go through the shared scheduler, if any, to stay within the account limits
+        if self.scheduler is None:
+            self.launch_run(instructions)
+            return
+        context = [instructions or self.assistant.instructions] + self.run_messages
+        self.run_estimate = self.scheduler.estimate_tokens(context)
+        self.scheduler.submit(self.stage, self.run_estimate, lambda: self.launch_run(instructions))
 
-    def run_assistant(self, instructions=None):
-        # Run the Assistant
-        self.run = self.client.beta.threads.runs.create(
+    def launch_run(self, instructions=None):
+        self.wait_thread_writable()
+        self.run_start = time.time()
+        try:
+            self.start_run(instructions)
+        except openai.NotFoundError:
+            if not self.registered_assistant:
+                raise
+            # the registered Assistant was deleted on the server, create it again and register the new one
+            print('the registered assistant %s is not found, create it again' % self.assistant.id)
+            self.registry.forget(self.assistant.name, self.assistant.instructions, self.assistant.model)
+            self.create_assistant(self.assistant.instructions, self.assistant.name, self.assistant.model)
+            self.start_run(instructions)
+
+    def add_cached_response(self, text):
+        # keep the thread coherent, as if the assistant had answered
+        self.wait_thread_writable()
+        self.client.beta.threads.messages.create(
             thread_id=self.thread.id,
-            assistant_id=self.assistant.id,
-            instructions=instructions
+            role="assistant",
+            content=text
         )
 
+    def start_run(self, instructions=None):
+        self.run_stream = None
+        if self.completion_mode == 'stream':
+            self.run_stream = self.client.beta.threads.runs.create(
+                thread_id=self.thread.id,
+                assistant_id=self.assistant.id,
+                instructions=instructions,
+                response_format=self.run_response_format or openai.NOT_GIVEN,
+                stream=True,
+                timeout=self.timeout
+            )
+            # the first event carries the created run, we need its id for later retrieval
+            for event in self.run_stream:
+                if event.event == 'thread.run.created':
+                    self.run = event.data
+                    break
+        else:
+            self.run = self.client.beta.threads.runs.create(
+                thread_id=self.thread.id,
+                assistant_id=self.assistant.id,
+                instructions=instructions,
+                response_format=self.run_response_format or openai.NOT_GIVEN
+            )
+
     def get_run_status(self):
         # Check the Run status
         return self.client.beta.threads.runs.retrieve(
@@ -89,33 +254,146 @@ class OpenAIGenericAssistant:
         )
         return messages
 
-    def wait_get_last_k_message(self, num=1):
-        # wait and get the last message
-        maxPolling = 120
-        period = 5
-        for i in range(1, maxPolling+1):
-            time.sleep(i * period)
-            print('polling run result after %d seconds' % (i * period))
+    def wait_run_completion(self):
+        # wait until the run reaches a terminal status, return the final run or None if time out
+        try:
+            if self.run_stream is not None:
+                run = self.wait_run_stream()
+            else:
+                run = self.poll_run()
+        except BaseException:
+            # the caller gives up on the run (i.e, KeyboardInterrupt), do not leave it running on the server
+            self.cancel_run()
+            raise
+
+        if run is None:
+            # the run is abandoned, it would keep consuming tokens and block the thread
+            self.cancel_run()
+        else:
+            # compare how long the run took on the server with how long we waited for it
+            wait_seconds = time.time() - self.run_start
+            run_seconds = None
+            # the expires_at of a run is its deadline, not when it finished, an expired run has no finish time,
+            # incomplete_at is missing from the older SDKs
+            finished_at = run.completed_at or run.failed_at or run.cancelled_at \
+                or getattr(run, 'incomplete_at', None)
+            if (run.created_at != None) and (finished_at != None):
+                run_seconds = finished_at - run.created_at
+            self.run_timing = {'run_seconds': run_seconds, 'wait_seconds': wait_seconds}
+            print('run %s, run took %s seconds, we waited %.2f seconds' % (run.status, run_seconds, wait_seconds))
+            self.record_usage(run)
+        return run
+
+    def extend_thread_digest(self, text):
+        # the request of the run and its response (None if the run did not complete) are now in the thread history
+        if self.cache_key is not None:
+            self.thread_digest = request_fingerprint(None, self.cache_key, text or '')
+
+    def record_response(self, text, latency):
+        # keep the response for an offline replay, see OpenAIReplayAssistant
+        self.extend_thread_digest(text)
+        if (self.recording is not None) and (self.cache_key is not None):
+            self.recording.record(self.stage, self.stateless, self.cache_key, text, self.last_usage, latency)
+
+    def record_usage(self, run, cached=False):
+        # capture the usage when the run finishes, so we never list the runs again to count the tokens
+        self.last_usage = usage_to_dict(None if cached else run.usage)
+        if (self.scheduler is not None) and not cached:
+            self.scheduler.settle(self.run_estimate, self.last_usage['total_tokens'])
+        if self.ledger is not None:
+            self.ledger.record(self.stage, self.last_usage, None if cached else run.id, cached)
+
+    def poll_run(self, deadline=None):
+        # poll with a short interval at first, and grow the interval for the long runs
+        interval = self.poll_interval
+        if deadline is None:
+            deadline = self.run_start + self.timeout
+        while True:
             run = self.get_run_status()
-            if(run.status == 'completed'):
-                print('run completed')
-                messages = self.get_last_k_message(num)
-                return messages
-            elif (run.status == 'cancelled'):
-                print('run cancelled')
-                return None
-            elif (run.status == 'failed'):
-                print('run failed')
-                return None
-            elif (run.status == 'expired'):
-                print('run expired')
-                return None
-            elif (i == maxPolling):
-                print ('last polling and time out in %d seconds' % period * maxPolling)
+            if run.status in TERMINAL_RUN_STATUSES:
+                self.run = run
+                return run
+            if time.time() + interval > deadline:
+                print('polling time out in %.2f seconds' % (time.time() - self.run_start))
                 return None
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+
+    def wait_run_stream(self):
+        # consume the run events until the run reaches a terminal status
+        try:
+            for event in self.run_stream:
+                if event.event in TERMINAL_RUN_EVENTS:
+                    self.run = event.data
+                    return self.run
+        except openai.APITimeoutError:
+            print('streaming time out in %d seconds' % self.timeout)
+            return None
+        finally:
+            self.run_stream = None
+        # the stream closed without a terminal event, fall back to polling
+        return self.poll_run()
+
+    def cancel_run(self):
+        # cancel the active run, return the final run or None if it is not cancelled in cancel_timeout
+        if (self.run is None) or (self.run.status in TERMINAL_RUN_STATUSES):
+            return self.run
+        if self.run_stream is not None:
+            self.run_stream.close()
+            self.run_stream = None
+        print('cancel run %s' % self.run.id)
+        try:
+            self.client.beta.threads.runs.cancel(
+                thread_id=self.thread.id,
+                run_id=self.run.id
+            )
+        except openai.BadRequestError:
+            # the run reached a terminal status before the cancel request
+            pass
+        # the run goes through 'cancelling', the thread stays locked until it is 'cancelled'
+        run = self.poll_run(time.time() + self.cancel_timeout)
+        if run is not None:
+            # the tokens consumed before the cancellation are billed too
+            self.record_usage(run)
+        return run
+
+    def wait_thread_writable(self):
+        # a thread with an active run rejects new messages and runs, the previous run was abandoned by its caller
+        if (self.run is not None) and (self.run.status not in TERMINAL_RUN_STATUSES):
+            if self.cancel_run() is None:
+                print('run %s is still active on thread %s' % (self.run.id, self.thread.id))
+
+    def wait_get_last_k_message(self, num=1):
+        # wait and get the last message
+        if self.cached_response is not None:
+            self.record_response(self.cached_response, 0)
+            return build_text_messages([self.cached_response])
+        run = self.wait_run_completion()
+        # a run failed by the rate limit is run again after the scheduler backs off
+        attempt = 0
+        while (run is not None) and (self.scheduler is not None) and is_rate_limited_run(run) \
+                and (attempt < self.scheduler.max_retries):
+            self.scheduler.backoff(attempt)
+            attempt += 1
+            self.submit_run(self.run_instructions)
+            run = self.wait_run_completion()
+        if run is None:
+            self.extend_thread_digest(None)
+            return None
+        elif run.status == 'completed':
+            messages = self.get_last_k_message(num)
+            text = messages.data[0].content[0].text.value
+            if (self.response_cache is not None) and (self.cache_key is not None):
+                self.response_cache.put(self.cache_key, text)
+            self.record_response(text, self.run_timing['wait_seconds'])
+            return messages
+        else:
+            print('run %s' % run.status)
+            self.extend_thread_digest(None)
+            return None
 
     def get_token_usage(self, tmin, tmax, limit=20):
-        # get the token usage in [tmin, tmax)
+        # get the token usage in [tmin, tmax), prefer the ledger, it needs no API calls and is exact
         runs = self.client.beta.threads.runs.list(
                 thread_id = self.thread.id,
                 order = 'desc',
@@ -128,9 +406,10 @@ class OpenAIGenericAssistant:
             if (run.created_at != None) and (run.completed_at != None) and \
                 (run.created_at >= tmin) and (run.created_at < tmax) and \
                 (run.completed_at >= tmin) and (run.completed_at < tmax):
-                token_usage['prompt_tokens'] += run.usage['prompt_tokens']
-                token_usage['completion_tokens'] += run.usage['completion_tokens']
-                token_usage['total_tokens'] += run.usage['total_tokens']
+                usage = usage_to_dict(run.usage)
+                token_usage['prompt_tokens'] += usage['prompt_tokens']
+                token_usage['completion_tokens'] += usage['completion_tokens']
+                token_usage['total_tokens'] += usage['total_tokens']
 
         return token_usage
 
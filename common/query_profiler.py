@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import os
+import json
+import bisect
+import threading
+
+
+# the upper bounds (in milliseconds) of the latency buckets, the last bucket has no bound
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+def latency_histogram(latencies):
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    for latency in latencies:
+        counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+    labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}ms']
+    return dict(zip(labels, counts))
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# the latency, the server timings, the record count and (optionally) the db hits of every query,
+# labeled by the stage of the caller (i.e, srcKind, metapath, statepath, state), see Neo4jQueryExecutor
+class QueryProfiler:
+    # profile_db_hits: run the queries with PROFILE to count the db hits, it adds overhead to every query
+    def __init__(self, profile_db_hits=False):
+        self.profile_db_hits = profile_db_hits
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, query, wall_ms, available_after_ms=None, consumed_after_ms=None, records=0,
+               db_hits=None):
+        entry = {'stage': stage or 'other', 'query': ' '.join(query.split())[:200], 'wall_ms': wall_ms,
+                 'available_after_ms': available_after_ms, 'consumed_after_ms': consumed_after_ms,
+                 'records': records, 'db_hits': db_hits}
+        with self.lock:
+            self.entries.append(entry)
+
+    def histograms(self):
+        # per stage: the number of queries, the latency percentiles and histogram, the records and db hits
+        stages = dict()
+        for entry in self.entries:
+            stages.setdefault(entry['stage'], []).append(entry)
+        summary = dict()
+        for stage, entries in stages.items():
+            wall = [entry['wall_ms'] for entry in entries]
+            server = [entry['available_after_ms'] + entry['consumed_after_ms'] for entry in entries
+                      if entry['available_after_ms'] is not None]
+            db_hits = [entry['db_hits'] for entry in entries if entry['db_hits'] is not None]
+            summary[stage] = {
+                'queries': len(entries),
+                'wall_ms_total': sum(wall),
+                'wall_ms_p50': percentile(wall, 0.5),
+                'wall_ms_p95': percentile(wall, 0.95),
+                'wall_ms_max': max(wall),
+                'wall_ms_histogram': latency_histogram(wall),
+                'server_ms_histogram': latency_histogram(server),
+                'records_total': sum(entry['records'] for entry in entries),
+                'db_hits_total': sum(db_hits) if db_hits else None,
+            }
+        return summary
+
+    def slowest(self, k=10):
+        return sorted(self.entries, key=lambda entry: entry['wall_ms'], reverse=True)[:k]
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'histograms': self.histograms(), 'slowest': self.slowest()}, f, indent=4)
+
+    def reset(self):
+        with self.lock:
+            self.entries = []
+
+
+# the db hits of all operators of a PROFILE plan
+def total_db_hits(profile):
+    if profile is None:
+        return None
+    return profile.get('dbHits', 0) + sum(total_db_hits(child) for child in profile.get('children', []))
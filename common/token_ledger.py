@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+
+TOKEN_KEYS = ['prompt_tokens', 'completion_tokens', 'total_tokens']
+
+
+# run.usage is an object from the API, a dict from the local backends, or None before the run completes
+def usage_to_dict(usage):
+    token_usage = {key: 0 for key in TOKEN_KEYS}
+    if usage is None:
+        return token_usage
+    for key in TOKEN_KEYS:
+        value = usage.get(key) if isinstance(usage, dict) else getattr(usage, key, None)
+        token_usage[key] = value or 0
+    return token_usage
+
+
+# the token usage of every run, captured when the run completes,
+# labeled by the error message being processed and the stage (locator / cypher / semantic) of the assistant
+class TokenLedger:
+    def __init__(self):
+        self.entries = []
+        self.message_key = None
+
+    def begin_message(self, message_key):
+        # the runs recorded from now on belong to this error message
+        self.message_key = message_key
+
+    def record(self, stage, usage, run_id=None, cached=False):
+        entry = {'message': self.message_key, 'stage': stage, 'run_id': run_id, 'cached': cached}
+        entry.update(usage_to_dict(usage))
+        self.entries.append(entry)
+
+    def select(self, message_key=None, stage=None):
+        return [entry for entry in self.entries
+                if (message_key is None or entry['message'] == message_key)
+                and (stage is None or entry['stage'] == stage)]
+
+    def usage(self, message_key=None, stage=None):
+        token_usage = {key: 0 for key in TOKEN_KEYS}
+        for entry in self.select(message_key, stage):
+            for key in TOKEN_KEYS:
+                token_usage[key] += entry[key]
+        return token_usage
+
+    def usage_by_stage(self, message_key=None):
+        stages = []
+        for entry in self.select(message_key):
+            if entry['stage'] not in stages:
+                stages.append(entry['stage'])
+        details = dict()
+        for stage in stages:
+            details[stage] = self.usage(message_key, stage)
+            details[stage]['runs'] = len(self.select(message_key, stage))
+        return details
@@ -14,11 +14,16 @@ from openai_root_cause_locator import build_prompt_template
 '''
 
 import json
-from common.openai_generic_assistant import OpenAIGenericAssistant
+import asyncio
+from common.assistant_factory import make_assistant
+from common.openai_generic_assistant import json_schema_format
+from common.async_openai_generic_assistant import AsyncOpenAIGenericAssistant
+from common.event_lookup import event_lookup, event_lookup_parameters, lucene_phrase
+from common.kind_catalog import NATIVE_EXTERNAL_KINDS_QUERY, split_native_external_kinds
+from find_metapath.metagraph_engine import MAX_METAPATH_LENGTH
 
 
-def setup_root_cause_locator():
-    instructions = """As an AI expert in Kubernetes (k8s) systems, you are equipped to understand the various components and API resources involved within a k8s cluster environment, as well as the external systems with which k8s interacts. Your expertise lies in analyzing k8s architectures and providing insightful diagnostic interpretations of the issues these systems might face.
+ROOT_CAUSE_LOCATOR_INSTRUCTIONS = """As an AI expert in Kubernetes (k8s) systems, you are equipped to understand the various components and API resources involved within a k8s cluster environment, as well as the external systems with which k8s interacts. Your expertise lies in analyzing k8s architectures and providing insightful diagnostic interpretations of the issues these systems might face.
 
 When provided with an error message or log output from a Kubernetes cluster, you are expected to perform the following steps:
 
@@ -44,10 +49,41 @@ Keep your output user-friendly and accessible for various skill levels— offer
 
 Remember to approach each situation as unique, using the information given to you in the error message as a starting point for your expert analysis."""
 
-    name = 'k8s-root-cause-locator'
-
-    rootCauseLocator = OpenAIGenericAssistant()
-    rootCauseLocator.create_assistant(instructions, name, 'gpt-4')
+ROOT_CAUSE_LOCATOR_NAME = 'k8s-root-cause-locator'
+
+# the structure of the locator output, enforced when the locator is set up with structured_output
+LOCATOR_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'SourceKind': {'type': 'string'},
+        'DestinationKind': {'type': 'string'},
+        'RelevantResources': {'type': 'array', 'items': {'type': 'string'}},
+        'PrimaryPath': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'Edge': {'type': 'integer'},
+                    'start': {'type': 'string'},
+                    'end': {'type': 'string'},
+                },
+                'required': ['Edge', 'start', 'end'],
+                'additionalProperties': False,
+            },
+        },
+    },
+    'required': ['SourceKind', 'DestinationKind', 'RelevantResources', 'PrimaryPath'],
+    'additionalProperties': False,
+}
+LOCATOR_RESPONSE_FORMAT = json_schema_format('root_cause_locator', LOCATOR_SCHEMA)
+
+
+# backend is 'assistants' (server-side thread) or 'chat' (stateless, constant cost per message)
+# assistant_options are passed to the assistant, i.e, response_cache, ledger, scheduler, registry, structured_output
+# (structured_output needs a model that supports it, i.e, gpt-4o)
+def setup_root_cause_locator(backend='assistants', model='gpt-4', **assistant_options):
+    rootCauseLocator = make_assistant(backend, stage='locator', **assistant_options)
+    rootCauseLocator.create_assistant(ROOT_CAUSE_LOCATOR_INSTRUCTIONS, ROOT_CAUSE_LOCATOR_NAME, model)
     rootCauseLocator.create_thread()
     #rootCauseLocator.retrieve_assistant(assistant_id='asst_RH9XJ35MOG0oaE5cdJwOWaDi')
     #rootCauseLocator.retrieve_thread(thread_id='thread_GtGvCyukMtkvZLyDrvaRiD9x')
@@ -60,37 +96,170 @@ Remember to approach each situation as unique, using the information given to yo
     return rootCauseLocator
 
 
+# run_limiter is shared with the other async assistants to bound the concurrent runs
+# assistant_options are passed to the assistant, i.e, ledger, scheduler, registry, structured_output
+async def async_setup_root_cause_locator(run_limiter=None, model='gpt-4', **assistant_options):
+    rootCauseLocator = AsyncOpenAIGenericAssistant(run_limiter, stage='locator', **assistant_options)
+    await rootCauseLocator.create_assistant(ROOT_CAUSE_LOCATOR_INSTRUCTIONS, ROOT_CAUSE_LOCATOR_NAME, model)
+    await rootCauseLocator.create_thread()
+
+    print(rootCauseLocator.assistant.id)
+    print(rootCauseLocator.thread.id)
+
+    return rootCauseLocator
+
+
+SRCKIND_QUERY = """
+    MATCH (n1:Event)-[s1:HasEvent]->(N1:EVENT)
+    WHERE N1.message contains $message
+    WITH n1, N1, s1
+    MATCH (n1:Event)-[r1:ReferInternal]->(n2)
+    WHERE r1.key = 'involvedObject_uid'
+    RETURN distinct n2.kind2
+    LIMIT 5;
+    """
+
+# the full-text index finds the candidate EVENT nodes by the exact phrase,
+# CONTAINS confirms them, so the result is the same as SRCKIND_QUERY without scanning every EVENT
+SRCKIND_FULLTEXT_QUERY = f"""
+{event_lookup('fulltext', 'N1')}
+    WITH N1
+    MATCH (n1:Event)-[s1:HasEvent]->(N1:EVENT)
+    WITH n1, N1, s1
+    MATCH (n1:Event)-[r1:ReferInternal]->(n2)
+    WHERE r1.key = 'involvedObject_uid'
+    RETURN distinct n2.kind2
+    LIMIT 5;
+    """
+
+
 def find_native_external_kinds(query_executor):
-    query = """
-        MATCH (n1)
-        WHERE n1.category IN ['NativeEntity', 'ExternalEntity']
-        RETURN n1.category AS category, n1.kind AS kind
-        """
-    records = query_executor.run_query(query)
-    nativeKinds = sorted([x['kind'] for x in records if (x['category'] == 'NativeEntity')])
-    externalKinds = sorted([x['kind'] for x in records if (x['category'] == 'ExternalEntity')])
-    return nativeKinds, externalKinds 
+    records = query_executor.run_query(NATIVE_EXTERNAL_KINDS_QUERY, stage='kinds')
+    return split_native_external_kinds(records)
 
 
-def find_srcKind(query_executor, message):
-    query = """
-        MATCH (n1:Event)-[s1:HasEvent]->(N1:EVENT)
-        WHERE N1.message contains $message
-        WITH n1, N1, s1
-        MATCH (n1:Event)-[r1:ReferInternal]->(n2)
-        WHERE r1.key = 'involvedObject_uid'
-        RETURN distinct n2.kind2
-        LIMIT 5;
-        """
-    parameters = {'message': message}
+def find_srcKind_query(message, mode='contains'):
+    if mode == 'contains':
+        return SRCKIND_QUERY, event_lookup_parameters(message, mode)
+    elif mode == 'fulltext':
+        return SRCKIND_FULLTEXT_QUERY, event_lookup_parameters(message, mode)
+    raise ValueError(f'unknown srcKind lookup mode {mode!r}')
+
+# mode: 'contains' scans the EVENT messages, 'fulltext' looks the message up in the full-text index (see neo4j_schema),
+# the phrase match works on tokens, a message that is cut in the middle of a token is looked up with CONTAINS again
+def find_srcKind(query_executor, message, mode='contains'):
     # Run the query and process the results
-    records = query_executor.run_query(query, parameters)
+    records = query_executor.run_query(*find_srcKind_query(message, mode), stage='srcKind')
+    if (len(records) == 0) and (mode == 'fulltext'):
+        records = query_executor.run_query(*find_srcKind_query(message), stage='srcKind')
+    srcKind = records[0]['n2.kind2']
+    print('srcKind = %s' % srcKind)
+    return srcKind
+
+
+# the async counterparts take an AsyncNeo4jQueryExecutor
+async def async_find_native_external_kinds(query_executor):
+    records = await query_executor.run_query(NATIVE_EXTERNAL_KINDS_QUERY, stage='kinds')
+    return split_native_external_kinds(records)
+
+
+async def async_find_srcKind(query_executor, message, mode='contains'):
+    records = await query_executor.run_query(*find_srcKind_query(message, mode), stage='srcKind')
+    if (len(records) == 0) and (mode == 'fulltext'):
+        records = await query_executor.run_query(*find_srcKind_query(message), stage='srcKind')
     srcKind = records[0]['n2.kind2']
     print('srcKind = %s' % srcKind)
     return srcKind
 
 
-def find_metapath(query_executor, srcKind, destKind, intermediateKinds=None):
+# the srcKind is looked up on the stategraph while the kinds are looked up on the metagraph
+async def async_find_srcKind_and_kinds(stategraph_query_executor, metagraph_query_executor, message, mode='contains'):
+    srcKind, (nativeKinds, externalKinds) = await asyncio.gather(
+        async_find_srcKind(stategraph_query_executor, message, mode),
+        async_find_native_external_kinds(metagraph_query_executor))
+    return srcKind, nativeKinds, externalKinds
+
+
+# the most metapaths a tier of the fallback chain returns
+METAPATH_LIMIT = 100
+
+
+def metapath_tier_subquery(tier, pattern, where):
+    # a tier runs only while the previous tiers found nothing, without input rows its MATCH is never evaluated,
+    # and collect() of no rows is still one row with an empty list, so the chain goes on
+    return f"""
+        CALL {{
+            WITH found
+            WITH found WHERE size(found) = 0
+            MATCH path = {pattern}
+            WHERE {where}
+            WITH path LIMIT $limit
+            RETURN collect(path) AS paths
+        }}
+        WITH CASE WHEN size(found) = 0 THEN paths ELSE found END AS found,
+            CASE WHEN size(found) = 0 AND size(paths) > 0 THEN '{tier}' ELSE tier END AS tier
+        """
+
+
+def build_metapath_chain_query():
+    # the fallback chain of find_metapath in one query, every directed and undirected length is a tier of its own,
+    # so the shortest paths are found first and the longer ones are never enumerated once there is a shorter one
+    filters = """n1.kind = $srcKind and n2.kind = $destKind
+            AND all(node in nodes(path) WHERE single(x in nodes(path) WHERE x = node))
+            AND all(node in nodes(path) WHERE not node.kind in ['Event', 'Namespace'])
+            AND ($intermediateKinds IS NULL
+                OR size($intermediateKinds) = 0
+                OR any(node in nodes(path)[1..-1] WHERE node.kind in $intermediateKinds))"""
+    query = """
+        WITH [] AS found, null AS tier
+        """
+    for direction, arrow in [('directed', '->'), ('undirected', '-')]:
+        for length in range(1, MAX_METAPATH_LENGTH + 1):
+            query += metapath_tier_subquery(f'{direction}-{length}', f'(n1)-[*{length}]{arrow}(n2)', filters)
+    query += metapath_tier_subquery('single', '(n1)-[r1]-(n2)', 'n1.kind = $srcKind and n2.kind = $destKind')
+    query += metapath_tier_subquery('namespace', '(n1)-[r1]-(n2)-[r2]-(n3)',
+                                    "n1.kind = $srcKind and n2.kind = 'Namespace' and n3.kind = $destKind")
+    query += """
+        UNWIND found AS path
+        RETURN tier, path
+        """
+    return query
+
+
+METAPATH_CHAIN_QUERY = build_metapath_chain_query()
+
+
+# the whole fallback chain of find_metapath in one round trip, return the tier that found the metapaths
+# (i.e, directed-2, undirected-1, single, namespace, or None) and at most limit metapaths of it
+def find_metapath_chain(query_executor, srcKind, destKind, intermediateKinds=None, limit=METAPATH_LIMIT):
+    interKinds = [x for x in (intermediateKinds or []) if x != 'Namespace']
+    parameters = {'srcKind': srcKind, 'destKind': destKind, 'intermediateKinds': interKinds, 'limit': limit}
+    records = query_executor.run_query(METAPATH_CHAIN_QUERY, parameters, stage='metapath')
+    if len(records) == 0:
+        return None, []
+    return records[0]['tier'], [record['path'] for record in records]
+
+
+# metagraph: a MetaGraph loaded once (see metagraph_engine), the metapaths are searched locally without any query,
+# or a MetapathIndex (see metapath_index), the metapaths are looked up
+# mode: 'sequential' runs the fallback queries one after another, 'chain' runs the whole chain in one query
+def find_metapath(query_executor, srcKind, destKind, intermediateKinds=None, metagraph=None, mode='sequential'):
+    if metagraph is not None:
+        metapaths = metagraph.find_metapath(srcKind, destKind, intermediateKinds)
+        for mp in metapaths:
+            print_metapath(path=mp)
+        return metapaths
+
+    if mode == 'chain':
+        tier, metapaths = find_metapath_chain(query_executor, srcKind, destKind, intermediateKinds)
+        if tier is None:
+            print('Can not find a path from %s to %s\n' % (srcKind, destKind))
+        else:
+            print('Found %d path(s) in the %s tier\n' % (len(metapaths), tier))
+        for mp in metapaths:
+            print_metapath(path=mp)
+        return metapaths
+
     # query with directed graph, support null intermeditateKinds
     query_directed = """
         MATCH path = (n1)-[*1..3]->(n2)
@@ -130,28 +299,27 @@ def find_metapath(query_executor, srcKind, destKind, intermediateKinds=None):
 
 
     # we prefer not use Namespace as intermediate kind, unless we have to include it 
-    interKinds = [x for x in intermediateKinds if x != 'Namespace']
+    interKinds = [x for x in (intermediateKinds or []) if x != 'Namespace']
 
     #parameters = {'srcKind': 'Pod', 'destKind': 'nfs', 'intermediateKinds': ['PersistentVolumeClaim', 'PersistentVolume', 'Node']}
     parameters = {'srcKind': srcKind, 'destKind': destKind, 'intermediateKinds': interKinds}
 
     # Run the query and process the results
     # we prefer the directed paths, so we run query_directed at first
-    print('Try to find a path in the directed graph ...\n')
-    records = query_executor.run_query(query_directed, parameters)
-    if len(records) == 0:
-        print('Can not find a path in the directed graph, try again with undirected graph ...\n')
-        records = query_executor.run_query(query_undirected, parameters)
-        if len(records) == 0:
-            print('Can not find a path in the undirected graph, try src-dest one-step path ...\n')
-            records = query_executor.run_query(query_single, parameters)
-            if len(records) == 0:
-                print('Can not find src-dest one-step path, try src-Namespace-dest path ...\n')
-                records = query_executor.run_query(query_namespace, parameters)
-    
+    # the fallback queries share one session
     # if there are many paths with different lenghts, we prefer the shortest paths (can be more than one path)
-    minLen = min([len(record['path']) for record in records])
-    metapaths = [record['path'] for record in records if len(record['path']) == minLen]
+    with query_executor.session_scope():
+        print('Try to find a path in the directed graph ...\n')
+        metapaths = shortest_paths(query_executor.stream_query(query_directed, parameters, stage='metapath'))
+        if len(metapaths) == 0:
+            print('Can not find a path in the directed graph, try again with undirected graph ...\n')
+            metapaths = shortest_paths(query_executor.stream_query(query_undirected, parameters, stage='metapath'))
+            if len(metapaths) == 0:
+                print('Can not find a path in the undirected graph, try src-dest one-step path ...\n')
+                metapaths = shortest_paths(query_executor.stream_query(query_single, parameters, stage='metapath'))
+                if len(metapaths) == 0:
+                    print('Can not find src-dest one-step path, try src-Namespace-dest path ...\n')
+                    metapaths = shortest_paths(query_executor.stream_query(query_namespace, parameters, stage='metapath'))
     
     # Here's how we process and print the paths
     for mp in metapaths:
@@ -159,6 +327,28 @@ def find_metapath(query_executor, srcKind, destKind, intermediateKinds=None):
     
     return metapaths
 
+# the top_k metapaths ranked by the coverage of the locator's relevant resources and the edge direction,
+# metagraph: a MetaGraph or a MetapathIndex
+def find_ranked_metapaths(metagraph, srcKind, destKind, relevantResources=None, top_k=3):
+    metapaths = metagraph.rank_metapaths(srcKind, destKind, relevantResources, top_k)
+    print('Ranked %d path(s) from %s to %s\n' % (len(metapaths), srcKind, destKind))
+    for mp in metapaths:
+        print_metapath(path=mp)
+    return metapaths
+
+# keep the shortest paths while the records stream in, the longer paths are dropped as they arrive
+def shortest_paths(records):
+    minLen = None
+    metapaths = []
+    for record in records:
+        path = record['path']
+        if (minLen is None) or (len(path) < minLen):
+            minLen = len(path)
+            metapaths = [path]
+        elif len(path) == minLen:
+            metapaths.append(path)
+    return metapaths
+
 def print_metapath(path):
     nodes = path.nodes
     relationships = path.relationships
@@ -180,8 +370,8 @@ def find_destKind_relevantResources(errorMessage, srcKind, promptTemplate, rootC
     prompt = promptTemplate.format(error_message = errorMessage, involved_object=srcKind)
     # add prompt as a message to the thread 
     rootCauseLocator.add_message(prompt)
-    # run the Assistant
-    rootCauseLocator.run_assistant()
+    # run the Assistant, the output follows LOCATOR_SCHEMA if the locator has structured_output
+    rootCauseLocator.run_assistant(response_format=LOCATOR_RESPONSE_FORMAT)
     # check the Run status
     # we can periodically retrieve the Run to check on its status to see if it has moved to completed
     
@@ -190,14 +380,27 @@ def find_destKind_relevantResources(errorMessage, srcKind, promptTemplate, rootC
 
     return json_data
 
+async def async_find_destKind_relevantResources(errorMessage, srcKind, promptTemplate, rootCauseLocator):
+    prompt = promptTemplate.format(error_message = errorMessage, involved_object=srcKind)
+    messages = await rootCauseLocator.ask(prompt, response_format=LOCATOR_RESPONSE_FORMAT)
+    json_data = extract_json(messages.data[0].content[0].text.value)
+
+    return json_data
+
 def extract_json(message_str):
+    # the structured output is the JSON itself, otherwise the JSON is put in a ```json block
+    try:
+        return json.loads(message_str)
+    except json.JSONDecodeError:
+        pass
     json_part = message_str.split('```json')[1].split('```')[0].strip()
     json_data = json.loads(json_part)
     return json_data
 
 
 
-def build_prompt_template(nativeKinds, externalKinds):
+# structured_output: the locator output follows LOCATOR_SCHEMA, so the JSON is not asked in a ```json block
+def build_prompt_template(nativeKinds, externalKinds, structured_output=False):
     # limit the kinds within the k8s-api-resource and k8s-external-resource kinds in metagraph
     prefix = (
         "The predefined k8s API resource kinds and external resource kinds are the following:\n\n"
@@ -208,6 +411,14 @@ def build_prompt_template(nativeKinds, externalKinds):
         external = ', '.join(externalKinds)
     )
 
+    if structured_output:
+        output_format = "5. Output the findings as a JSON object without additional descriptions, following the given structure:\n"
+    else:
+        output_format = (
+            "5. Output the findings in JSON format encapsulated within triple backticks and the 'json' specifier for clear demarcation as a code block. The JSON output should not contain additional descriptions and must follow the given structure:\n"
+            "```json"
+        )
+
     # decribe the steps to perform, use {involved_object} and {error_message} as placeholders
     requirement = (
         "Perform an analysis on the Kubernetes error message that mentions a {involved_object}. "
@@ -219,8 +430,7 @@ def build_prompt_template(nativeKinds, externalKinds):
         "within the predefined kinds.\n"
         "4. Chart the primary progression from {involved_object} to 'destKind', including the most relevant "
         "resources as waypoints.\n"
-        "5. Output the findings in JSON format encapsulated within triple backticks and the 'json' specifier for clear demarcation as a code block. The JSON output should not contain additional descriptions and must follow the given structure:\n"
-        "```json"
+        + output_format +
         "{{\n"
         "    'SourceKind': {involved_object},\n"
         "    'DestinationKind': 'destKind', // 'destKind' must be from the predefined resource kinds list\n"
@@ -232,7 +442,7 @@ def build_prompt_template(nativeKinds, externalKinds):
         "                    {{'Edge': n, 'start': 'Resource(n-1)', 'end': 'destKind'}}\n"
         "                    ]\n"
         "}}\n"
-        "```"
+        + ("" if structured_output else "```") +
         "Analyze the following error message ensuring 'destKind' and 'Resources-x' are strictly limited to the provided lists:\n\n"
         "{error_message}\n"
     )
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import collections
+
+from common.kind_catalog import METAGRAPH_VERSION_LABEL
+
+
+# the kinds that never appear in a directed or undirected metapath
+EXCLUDED_KINDS = ['Event', 'Namespace']
+
+# the longest directed or undirected metapath, like [*1..3] in the metapath queries
+MAX_METAPATH_LENGTH = 3
+
+# the extra cost of walking a relationship backwards in the ranked metapaths, a directed path costs its length
+DIRECTION_PENALTY = 0.5
+
+# the score of every relevant resource a ranked metapath passes through
+COVERAGE_WEIGHT = 1.0
+
+
+# a metagraph node, the properties are read like a neo4j Node, i.e, node['kind']
+class MetaNode(dict):
+    def __init__(self, element_id, properties):
+        super().__init__(properties)
+        self.element_id = element_id
+
+    def __hash__(self):
+        return hash(self.element_id)
+
+    def __eq__(self, other):
+        return isinstance(other, MetaNode) and (self.element_id == other.element_id)
+
+
+# a metagraph relationship, like a neo4j Relationship, i.e, relationship.type, relationship['key']
+class MetaRelationship(dict):
+    def __init__(self, element_id, rel_type, start_node, end_node, properties):
+        super().__init__(properties)
+        self.element_id = element_id
+        self.type = rel_type
+        self.start_node = start_node
+        self.end_node = end_node
+
+    def __hash__(self):
+        return hash(self.element_id)
+
+    def __eq__(self, other):
+        return isinstance(other, MetaRelationship) and (self.element_id == other.element_id)
+
+
+# a metapath, like a neo4j Path, so print_metapath and extend_metapath_construct_string take it as it is
+class MetaPath:
+    def __init__(self, nodes, relationships):
+        self.nodes = tuple(nodes)
+        self.relationships = tuple(relationships)
+
+    @property
+    def start_node(self):
+        return self.nodes[0]
+
+    @property
+    def end_node(self):
+        return self.nodes[-1]
+
+    def __len__(self):
+        # the length of a path is the number of relationships
+        return len(self.relationships)
+
+    def __iter__(self):
+        return iter(self.relationships)
+
+    def __repr__(self):
+        return ' - '.join(node['kind'] for node in self.nodes)
+
+    def backward_steps(self):
+        # the relationships walked against their direction
+        return sum(1 for node, rel in zip(self.nodes, self.relationships) if rel.start_node != node)
+
+    def signature(self):
+        # the kinds and the relationship types with their direction, the paths over parallel edges are the same
+        signature = [self.nodes[0]['kind']]
+        for node, rel, next_node in zip(self.nodes, self.relationships, self.nodes[1:]):
+            signature += [rel.type if rel.start_node == node else '<' + rel.type, next_node['kind']]
+        return tuple(signature)
+
+
+# the metagraph is a small static schema graph, it is loaded once and the metapaths are searched locally,
+# with the same rules and fallback chain as find_metapath, instead of up to four queries per error message
+class MetaGraph:
+    def __init__(self, nodes, relationships):
+        self.nodes = {node.element_id: node for node in nodes}
+        self.relationships = list(relationships)
+        self.nodes_by_kind = collections.defaultdict(list)
+        for node in nodes:
+            self.nodes_by_kind[node['kind']].append(node)
+        # the adjacency lists, (relationship, neighbor) of every node
+        self.outgoing = collections.defaultdict(list)
+        self.incoming = collections.defaultdict(list)
+        for rel in relationships:
+            self.outgoing[rel.start_node.element_id].append((rel, rel.end_node))
+            self.incoming[rel.end_node.element_id].append((rel, rel.start_node))
+
+    @classmethod
+    def load(cls, query_executor):
+        # the version stamp (see kind_catalog) is not a part of the schema graph
+        node_records = query_executor.run_query(f"""
+            MATCH (n)
+            WHERE NOT n:{METAGRAPH_VERSION_LABEL}
+            RETURN elementId(n) AS id, properties(n) AS properties
+            """)
+        nodes = {record['id']: MetaNode(record['id'], record['properties']) for record in node_records}
+        rel_records = query_executor.run_query("""
+            MATCH (n1)-[r]->(n2)
+            RETURN elementId(r) AS id, type(r) AS type, elementId(n1) AS start, elementId(n2) AS end,
+                properties(r) AS properties
+            """)
+        relationships = [MetaRelationship(record['id'], record['type'], nodes[record['start']], nodes[record['end']],
+                                          record['properties'])
+                         for record in rel_records]
+        return cls(list(nodes.values()), relationships)
+
+    def kinds(self):
+        return sorted(self.nodes_by_kind.keys())
+
+    def neighbors(self, node, directed):
+        if directed:
+            return self.outgoing[node.element_id]
+        return self.outgoing[node.element_id] + self.incoming[node.element_id]
+
+    def walk(self, nodes, relationships, length, directed, destKind, excludedKinds, unique):
+        # extend the path to the given length, the last node must be of destKind (any kind if destKind is None)
+        if len(relationships) == length:
+            yield MetaPath(nodes, relationships)
+            return
+        last_step = (len(relationships) + 1 == length)
+        for rel, neighbor in self.neighbors(nodes[-1], directed):
+            if rel in relationships:
+                continue
+            if unique and (neighbor in nodes):
+                continue
+            if neighbor['kind'] in excludedKinds:
+                continue
+            if last_step and (destKind is not None) and (neighbor['kind'] != destKind):
+                continue
+            yield from self.walk(nodes + [neighbor], relationships + [rel], length, directed, destKind, excludedKinds,
+                                 unique)
+
+    def enumerate_paths(self, srcKind, destKind, length, directed, excludedKinds=(), unique=True):
+        paths = []
+        if srcKind in excludedKinds:
+            return paths
+        for src in self.nodes_by_kind.get(srcKind, []):
+            paths += list(self.walk([src], [], length, directed, destKind, excludedKinds, unique))
+        return paths
+
+    def shortest_metapaths(self, srcKind, destKind, interKinds, directed):
+        # the paths of [*1..MAX_METAPATH_LENGTH] with unique nodes and without Event / Namespace,
+        # passing through one of interKinds if any, only the shortest ones are kept
+        for length in range(1, MAX_METAPATH_LENGTH + 1):
+            paths = [path for path in self.enumerate_paths(srcKind, destKind, length, directed, EXCLUDED_KINDS)
+                     if (len(interKinds) == 0) or any(node['kind'] in interKinds for node in path.nodes[1:-1])]
+            if paths:
+                return paths
+        return []
+
+    def single_metapaths(self, srcKind, destKind):
+        # src and dest are connected, in either direction
+        return self.enumerate_paths(srcKind, destKind, 1, False, unique=False)
+
+    def namespace_metapaths(self, srcKind, destKind):
+        # srcKind-Namespace-destKind
+        paths = []
+        for path in self.enumerate_paths(srcKind, 'Namespace', 1, False, unique=False):
+            for rel, neighbor in self.neighbors(path.end_node, False):
+                if (rel not in path.relationships) and (neighbor['kind'] == destKind):
+                    paths.append(MetaPath(path.nodes + (neighbor,), path.relationships + (rel,)))
+        return paths
+
+    def find_metapath(self, srcKind, destKind, intermediateKinds=None):
+        # the same fallback chain as find_metapath: directed, undirected, src-dest one-step, src-Namespace-dest
+        interKinds = [x for x in (intermediateKinds or []) if x != 'Namespace']
+        print('Try to find a path in the directed graph ...\n')
+        metapaths = self.shortest_metapaths(srcKind, destKind, interKinds, True)
+        if len(metapaths) == 0:
+            print('Can not find a path in the directed graph, try again with undirected graph ...\n')
+            metapaths = self.shortest_metapaths(srcKind, destKind, interKinds, False)
+            if len(metapaths) == 0:
+                print('Can not find a path in the undirected graph, try src-dest one-step path ...\n')
+                metapaths = self.single_metapaths(srcKind, destKind)
+                if len(metapaths) == 0:
+                    print('Can not find src-dest one-step path, try src-Namespace-dest path ...\n')
+                    metapaths = self.namespace_metapaths(srcKind, destKind)
+        return metapaths
+
+    def path_cost(self, path, direction_penalty):
+        return len(path) + direction_penalty * path.backward_steps()
+
+    def cheapest_path(self, src, dest, direction_penalty, removed_nodes, removed_rels):
+        # dijkstra from src to dest, a relationship costs 1, plus direction_penalty when walked backwards
+        counter = itertools.count()
+        heap = [(0, next(counter), src, None)]
+        settled = dict()
+        while heap:
+            cost, _, node, previous = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = previous
+            if node == dest:
+                break
+            for rel, neighbor in self.neighbors(node, False):
+                if (neighbor in settled) or (neighbor in removed_nodes) or (rel in removed_rels):
+                    continue
+                if (neighbor != dest) and (neighbor['kind'] in EXCLUDED_KINDS):
+                    continue
+                step = 1 + (direction_penalty if rel.start_node != node else 0)
+                heapq.heappush(heap, (cost + step, next(counter), neighbor, (node, rel)))
+        if dest not in settled:
+            return None
+        nodes, relationships = [dest], []
+        while settled[nodes[-1]] is not None:
+            node, rel = settled[nodes[-1]]
+            nodes.append(node)
+            relationships.append(rel)
+        return MetaPath(reversed(nodes), reversed(relationships))
+
+    def k_shortest_paths(self, src, dest, direction_penalty, max_length):
+        # yen's algorithm, the loopless paths by increasing cost, until the cost exceeds any path of max_length
+        max_cost = max_length * (1 + direction_penalty)
+        first = self.cheapest_path(src, dest, direction_penalty, set(), set())
+        if first is None:
+            return
+        found = [first]
+        counter = itertools.count()
+        candidates = []
+        seen = {(first.nodes, first.relationships)}
+        while True:
+            path = found[-1]
+            if self.path_cost(path, direction_penalty) > max_cost:
+                return
+            if len(path) <= max_length:
+                yield path
+            for i in range(len(path)):
+                # branch off at the i-th node, without the relationships the found paths take from the same root
+                root_nodes, root_rels = path.nodes[:i + 1], path.relationships[:i]
+                removed_rels = {p.relationships[i] for p in found
+                                if (p.nodes[:i + 1] == root_nodes) and (p.relationships[:i] == root_rels)}
+                spur = self.cheapest_path(root_nodes[-1], dest, direction_penalty, set(root_nodes[:-1]), removed_rels)
+                if spur is None:
+                    continue
+                candidate = MetaPath(root_nodes + spur.nodes[1:], root_rels + spur.relationships)
+                if (candidate.nodes, candidate.relationships) in seen:
+                    continue
+                seen.add((candidate.nodes, candidate.relationships))
+                heapq.heappush(candidates, (self.path_cost(candidate, direction_penalty), next(counter), candidate))
+            if not candidates:
+                return
+            found.append(heapq.heappop(candidates)[2])
+
+    def rank_metapaths(self, srcKind, destKind, relevantResources=None, top_k=3, direction_penalty=DIRECTION_PENALTY,
+                       coverage_weight=COVERAGE_WEIGHT, max_length=MAX_METAPATH_LENGTH):
+        # the k-shortest paths up to max_length in either direction, scored by their cost minus the coverage of the
+        # relevant resources (the kinds suggested by the root cause locator) they pass through,
+        # the paths with the same signature are merged, and only the top_k are kept
+        relevant = set(relevantResources or []) - {srcKind, destKind}
+        paths = []
+        for src in self.nodes_by_kind.get(srcKind, []):
+            for dest in self.nodes_by_kind.get(destKind, []):
+                if src != dest:
+                    paths += list(self.k_shortest_paths(src, dest, direction_penalty, max_length))
+        if len(paths) == 0:
+            # no path avoids Event / Namespace, rank the one-step and Namespace paths of the fallback chain
+            paths = self.single_metapaths(srcKind, destKind) or self.namespace_metapaths(srcKind, destKind)
+
+        def score(path):
+            covered = {node['kind'] for node in path.nodes[1:-1]} & relevant
+            return self.path_cost(path, direction_penalty) - coverage_weight * len(covered)
+
+        ranked = []
+        signatures = set()
+        for path in sorted(paths, key=lambda p: (score(p), self.path_cost(p, direction_penalty))):
+            if path.signature() in signatures:
+                continue
+            signatures.add(path.signature())
+            ranked.append(path)
+        return ranked[:top_k]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import os
+import json
+
+from common.kind_catalog import metagraph_fingerprint
+from find_metapath.metagraph_engine import MetaGraph, MetaNode, MetaRelationship, MetaPath, \
+    EXCLUDED_KINDS, MAX_METAPATH_LENGTH
+
+
+# the shortest directed and undirected metapaths of every (srcKind, destKind) pair, computed offline,
+# and for every intermediate kind the shortest metapaths passing through it,
+# so a lookup with intermediateKinds gives the same metapaths as the search of find_metapath,
+# the index keeps the metagraph_fingerprint (see kind_catalog) it was built for, not the element ids,
+# so it survives a reload of the same metagraph and is rebuilt once the metagraph changes
+class MetapathIndex:
+    VERSION = 2
+    TIERS = {'directed': True, 'undirected': False}
+
+    def __init__(self, fingerprint, metagraph, entries):
+        self.fingerprint = fingerprint
+        # the single-step and Namespace fallbacks are searched on the metagraph, they are one or two hops
+        self.metagraph = metagraph
+        # entries[srcKind][destKind][tier] = {'shortest': [path], 'via': {kind: [path]}},
+        # a path is the id of its srcKind node followed by the ids of its relationships
+        self.entries = entries
+
+    @classmethod
+    def build(cls, metagraph, fingerprint=None):
+        entries = dict()
+        for tier, directed in cls.TIERS.items():
+            for srcKind in metagraph.kinds():
+                for length in range(1, MAX_METAPATH_LENGTH + 1):
+                    for path in metagraph.enumerate_paths(srcKind, None, length, directed, EXCLUDED_KINDS):
+                        entry = entries.setdefault(srcKind, dict()).setdefault(path.end_node['kind'], dict()) \
+                            .setdefault(tier, {'shortest': [], 'via': dict()})
+                        ids = [path.start_node.element_id] + [rel.element_id for rel in path.relationships]
+                        cls.keep_shortest(entry['shortest'], ids)
+                        for kind in {node['kind'] for node in path.nodes[1:-1]}:
+                            cls.keep_shortest(entry['via'].setdefault(kind, []), ids)
+        return cls(fingerprint, metagraph, entries)
+
+    @staticmethod
+    def keep_shortest(paths, ids):
+        # the paths are enumerated by length, a longer path is never added once there is a shorter one
+        if (len(paths) == 0) or (len(ids) == len(paths[0])):
+            paths.append(ids)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        index = {
+            'version': self.VERSION,
+            'fingerprint': self.fingerprint,
+            'nodes': [{'id': node.element_id, 'properties': dict(node)} for node in self.metagraph.nodes.values()],
+            'relationships': [{'id': rel.element_id, 'type': rel.type, 'start': rel.start_node.element_id,
+                               'end': rel.end_node.element_id, 'properties': dict(rel)}
+                              for rel in self.metagraph.relationships],
+            'entries': self.entries,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        # None if there is no index, or it is of another version
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            index = json.load(f)
+        if index.get('version') != cls.VERSION:
+            return None
+        nodes = {node['id']: MetaNode(node['id'], node['properties']) for node in index['nodes']}
+        relationships = [MetaRelationship(rel['id'], rel['type'], nodes[rel['start']], nodes[rel['end']],
+                                          rel['properties'])
+                         for rel in index['relationships']]
+        metagraph = MetaGraph(list(nodes.values()), relationships)
+        return cls(index['fingerprint'], metagraph, index['entries'])
+
+    # reuse the index on disk unless the metagraph changed since it was built, the metagraph is loaded only to
+    # rebuild it, fingerprint: the metagraph_fingerprint if the caller has it already
+    @classmethod
+    def load_or_build(cls, path, query_executor, fingerprint=None):
+        fingerprint = fingerprint or metagraph_fingerprint(query_executor)
+        index = cls.load(path)
+        if (index is not None) and (index.fingerprint == fingerprint):
+            return index
+        print('build the metapath index for the metagraph %s' % fingerprint[:12])
+        index = cls.build(MetaGraph.load(query_executor), fingerprint)
+        index.save(path)
+        return index
+
+    def to_metapath(self, ids):
+        relationships = [self.relationships_by_id[rel_id] for rel_id in ids[1:]]
+        nodes = [self.metagraph.nodes[ids[0]]]
+        for rel in relationships:
+            # walk the relationship from the node we are at, in the undirected metapaths it may point backwards
+            nodes.append(rel.end_node if rel.start_node == nodes[-1] else rel.start_node)
+        return MetaPath(nodes, relationships)
+
+    @property
+    def relationships_by_id(self):
+        if not hasattr(self, '_relationships_by_id'):
+            self._relationships_by_id = {rel.element_id: rel for rel in self.metagraph.relationships}
+        return self._relationships_by_id
+
+    def lookup(self, srcKind, destKind, interKinds, tier):
+        entry = self.entries.get(srcKind, dict()).get(destKind, dict()).get(tier)
+        if entry is None:
+            return []
+        if len(interKinds) == 0:
+            candidates = entry['shortest']
+        else:
+            # the shortest paths through any of interKinds, are the shortest of the paths through each of them
+            via = [entry['via'][kind] for kind in interKinds if kind in entry['via']]
+            if len(via) == 0:
+                return []
+            minLen = min(len(paths[0]) for paths in via)
+            candidates = []
+            for paths in via:
+                for ids in paths:
+                    if (len(ids) == minLen) and (ids not in candidates):
+                        candidates.append(ids)
+        return [self.to_metapath(ids) for ids in candidates]
+
+    def find_metapath(self, srcKind, destKind, intermediateKinds=None):
+        # the same fallback chain as MetaGraph.find_metapath, the first two tiers are looked up
+        interKinds = [x for x in (intermediateKinds or []) if x != 'Namespace']
+        print('Try to find a path in the directed graph ...\n')
+        metapaths = self.lookup(srcKind, destKind, interKinds, 'directed')
+        if len(metapaths) == 0:
+            print('Can not find a path in the directed graph, try again with undirected graph ...\n')
+            metapaths = self.lookup(srcKind, destKind, interKinds, 'undirected')
+            if len(metapaths) == 0:
+                print('Can not find a path in the undirected graph, try src-dest one-step path ...\n')
+                metapaths = self.metagraph.single_metapaths(srcKind, destKind)
+                if len(metapaths) == 0:
+                    print('Can not find src-dest one-step path, try src-Namespace-dest path ...\n')
+                    metapaths = self.metagraph.namespace_metapaths(srcKind, destKind)
+        return metapaths
+
+    def rank_metapaths(self, srcKind, destKind, relevantResources=None, top_k=3, **options):
+        # the ranking depends on the locator's relevant resources, it is searched on the metagraph
+        return self.metagraph.rank_metapaths(srcKind, destKind, relevantResources, top_k, **options)
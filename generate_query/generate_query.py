@@ -13,13 +13,41 @@ from openai_cypher_query_generator import OpenAICypherQueryGenerator
 from openai_cypher_query_generator import build_generation_template
 '''
 
-from common.openai_generic_assistant import OpenAIGenericAssistant
-
-def setup_cypher_generator():
-    instructions="You are an expert in neo4j and cypher query language."
-    name="cypher-query-generator"
-    cypherQueryGenerator = OpenAIGenericAssistant()
-    cypherQueryGenerator.create_assistant(instructions, name, 'gpt-4')
+import re
+import json
+import time
+import neo4j
+import threading
+from common.assistant_factory import make_assistant
+from common.openai_generic_assistant import json_schema_format
+from common.async_openai_generic_assistant import AsyncOpenAIGenericAssistant
+from common.kind_catalog import entity_name_key, entity_kind_key
+from common.event_lookup import EVENT_LOOKUPS, event_lookup, event_lookup_parameters
+
+CYPHER_GENERATOR_INSTRUCTIONS = "You are an expert in neo4j and cypher query language."
+CYPHER_GENERATOR_NAME = "cypher-query-generator"
+LABEL_MESSAGE = "Let's label the following prompt template as generation-template-1, and use it to generate cypher query later"
+
+# the structure of the generator output, enforced when the generator is set up with structured_output
+CYPHER_SCHEMA = {
+    'type': 'object',
+    'properties': {'cypher_query': {'type': 'string'}},
+    'required': ['cypher_query'],
+    'additionalProperties': False,
+}
+CYPHER_RESPONSE_FORMAT = json_schema_format('cypher_query', CYPHER_SCHEMA)
+
+# the labeled generation template is a part of the instructions rather than seeded messages,
+# so a registered Assistant is ready to use without seeding every new thread
+def build_cypher_generator_instructions():
+    return '\n\n'.join([CYPHER_GENERATOR_INSTRUCTIONS, LABEL_MESSAGE, build_generation_template()])
+
+# backend is 'assistants' (server-side thread) or 'chat' (stateless, constant cost per message)
+# assistant_options are passed to the assistant, i.e, response_cache, ledger, scheduler, registry, structured_output
+# (structured_output needs a model that supports it, i.e, gpt-4o)
+def setup_cypher_generator(backend='assistants', model='gpt-4', **assistant_options):
+    cypherQueryGenerator = make_assistant(backend, stage='cypher', **assistant_options)
+    cypherQueryGenerator.create_assistant(build_cypher_generator_instructions(), CYPHER_GENERATOR_NAME, model)
     cypherQueryGenerator.create_thread()
    
     #cypherQueryGenerator.retrieve_assistant(assistant_id="asst_m8xzRVAXj0feSEnkK4mMeuVs")
@@ -33,13 +61,19 @@ def setup_cypher_generator():
     
     print(f'https://platform.openai.com/playground?assistant={cypherQueryGenerator.assistant.id}&thread={cypherQueryGenerator.thread.id}')
 
+    return cypherQueryGenerator
 
-    label_message = "Let's label the following prompt template as generation-template-1, and use it to generate cypher query later"
-    cypherQueryGenerator.add_message(label_message)
 
-    generation_template = build_generation_template()
-    cypherQueryGenerator.add_message(generation_template)
-    
+# run_limiter is shared with the other async assistants to bound the concurrent runs
+# assistant_options are passed to the assistant, i.e, ledger, scheduler, registry, structured_output
+async def async_setup_cypher_generator(run_limiter=None, model='gpt-4', **assistant_options):
+    cypherQueryGenerator = AsyncOpenAIGenericAssistant(run_limiter, stage='cypher', **assistant_options)
+    await cypherQueryGenerator.create_assistant(build_cypher_generator_instructions(), CYPHER_GENERATOR_NAME, model)
+    await cypherQueryGenerator.create_thread()
+
+    print(cypherQueryGenerator.assistant.id)
+    print(cypherQueryGenerator.thread.id)
+
     return cypherQueryGenerator
 
 
@@ -57,22 +91,32 @@ def extend_metapath_construct_string(partial_path):
     return rels_str
 
 # Note: metapath is a string here
-def generate_cypher_query(metapath_str, error_message, cypherQueryGenerator):
-    # build the prompt 
-    prompt = f"""
-    Let's use generation-template-1 and generate a cypher query for the following example. Strictly follow the (srcKind)-[rel]->(destkind) ordering, don't reverse it. Return the generated query in the following format:
+# structured_output: the output follows CYPHER_SCHEMA, so the query is not asked in a ```cypher block
+def build_cypher_prompt(metapath_str, error_message, structured_output=False):
+    if structured_output:
+        output_format = "Return the generated query as the plain text of cypher_query."
+    else:
+        output_format = """Return the generated query in the following format:
     ```cypher
     generated_cypher_query
-    ```
+    ```"""
+    prompt = f"""
+    Let's use generation-template-1 and generate a cypher query for the following example. Strictly follow the (srcKind)-[rel]->(destkind) ordering, don't reverse it. {output_format}
     the provided metapath is:
     {metapath_str}
     the error message to filtering is:
     {error_message}
     """
+    return prompt
+
+# Note: metapath is a string here
+def generate_cypher_query(metapath_str, error_message, cypherQueryGenerator):
+    # build the prompt 
+    prompt = build_cypher_prompt(metapath_str, error_message, cypherQueryGenerator.structured_output)
     cypherQueryGenerator.add_message(prompt)
 
     print('run assistant')
-    cypherQueryGenerator.run_assistant()
+    cypherQueryGenerator.run_assistant(response_format=CYPHER_RESPONSE_FORMAT)
     messages = cypherQueryGenerator.wait_get_last_k_message(1)
     cypher_query = extract_cypher(messages.data[0].content[0].text.value)
     
@@ -80,21 +124,39 @@ def generate_cypher_query(metapath_str, error_message, cypherQueryGenerator):
 
     return cypher_query
 
-def extract_cypher(message_str):
-    cypher_part = message_str.split('```cypher')[1].split('```')[0].strip()
-    return cypher_part
+async def async_generate_cypher_query(metapath_str, error_message, cypherQueryGenerator):
+    prompt = build_cypher_prompt(metapath_str, error_message, cypherQueryGenerator.structured_output)
+    messages = await cypherQueryGenerator.ask(prompt, response_format=CYPHER_RESPONSE_FORMAT)
+    cypher_query = extract_cypher(messages.data[0].content[0].text.value)
 
+    print('the generated cypher query is :\n %s' % cypher_query)
 
-def run_and_filter_query(query_executor, cypher_query):
-    # the records may contains dest nodes that not mentioned by the EVENT
-    records = query_executor.run_query(cypher_query)
+    return cypher_query
 
+def extract_cypher(message_str):
+    # the structured output is a JSON object following CYPHER_SCHEMA, otherwise the query is put in a ```cypher block,
+    # the model may still fence the query inside cypher_query
+    try:
+        cypher_part = json.loads(message_str)['cypher_query']
+    except (json.JSONDecodeError, TypeError, KeyError):
+        cypher_part = message_str
+    if '```cypher' in cypher_part:
+        cypher_part = cypher_part.split('```cypher')[1].split('```')[0]
+    return cypher_part.strip()
+
+
+# limit: keep at most limit compatible records and stop pulling the rest, None to keep all of them
+def run_and_filter_query(query_executor, cypher_query, limit=None, parameters=None):
+    # the records may contains dest nodes that not mentioned by the EVENT
     # by default, EVENT is the 2nd element, dest is the last element. 
     # i.e, RETURN event, r1, evt, r2, pod, r3, secret 
-    res = []
-    for record in records:
-        if message_compatible(record):
-            res.append(record)
+    # stream the records, so the incompatible ones are dropped as they arrive instead of being held in memory
+    if limit is not None:
+        res = query_executor.find_first_n(cypher_query, parameters, n=limit, predicate=message_compatible,
+                                          stage='statepath')
+    else:
+        res = [record for record in query_executor.stream_query(cypher_query, parameters, stage='statepath')
+               if message_compatible(record)]
     
     if len(res) == 0:
         print('Warning: ALL records are not message compatible')
@@ -108,25 +170,8 @@ def message_compatible(record):
             message = ele['message'] 
     # by default, dest is the last element
     dest = record[len(record)-1]
-    # check if the name is in the message
-    if dest['isNative'] == 'true':
-        k1 = 'name2'
-    elif dest['isAtomic'] == 'true':
-        k1 = 'val'
-    elif dest['tag'] in ['nfs', 'hostPath']:
-        k1 = 'path'
-    elif dest['tag'] == 'container':
-        k1 = 'containerName'
-    elif dest['tag'] == 'image':
-        k1 = 'imageName'
-   
-    # check if the kind is in the message
-    if dest['isNative'] == 'true':
-        k2 = 'kind2'
-    elif dest['isNative'] == 'false':
-        k2 = 'tag'
-
-    return (dest[k1] in message) or (dest[k2] in message)
+    # check if the name or the kind is in the message
+    return (dest[entity_name_key(dest)] in message) or (dest[entity_kind_key(dest)] in message)
    
 
 
@@ -211,58 +256,197 @@ RETURN startNode, rel, destNode, …
     return template
 
 
-def human_generate_cypher_query(metapath_str, error_message):
-    # Parse the metapath string into list
-    mp = metapath_str.split(';')[:-1]
-    metapath = [rel.strip().split(', ') for rel in mp]
-    
-    # Start with Filtering EVENT Nodes
-    query_parts = []
-    node_aliases = {"EVENT": "evt"}
+# the labels and relationship types can not be parameters, they go into the query text, so they are checked
+IDENTIFIER_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
 
-    query_parts.append(f"""
-MATCH (evt:EVENT)
-WHERE evt.message CONTAINS {repr(error_message)}
+# the EVENT of the error message, looked up like find_srcKind (see event_lookup)
+def statepath_event_lookup(mode):
+    return f"""
+{event_lookup(mode, 'evt')}
 WITH evt
-LIMIT 1""")
-
-    # Build node alias for each srcKind and destKind
-    idx = 1
-    for rel in metapath:
-        srcKind = rel[1]
-        destKind = rel[2]
-        if srcKind not in node_aliases:
-            node_aliases[srcKind] = f"n{idx}"
-            idx += 1
-        if destKind not in node_aliases:
-            node_aliases[destKind] = f"n{idx}"
-            idx += 1
-
-    # Chain MATCH Clauses Based on the Metapath with Timely Filtering
-    for idx, (relType, srcKind, destKind, propertyValue) in enumerate(metapath, start=1):
-        srcAlias = node_aliases[srcKind]
-        destAlias = node_aliases[destKind]
-
+LIMIT 1"""
+
+
+def identifier(name):
+    if not IDENTIFIER_PATTERN.match(name):
+        raise ValueError(f'invalid label or relationship type {name!r}')
+    return f'`{name}`'
+
+
+# the deterministic statepath queries compiled once per metapath, the error message and the relationship keys
+# are parameters ($message, $keys), so a repeated metapath reuses both the query text and the execution plan
+# Neo4j cached for it, and a message with quotes needs no escaping,
+# the number of statepaths is bounded by run_and_filter_query, it stops pulling once it has enough compatible ones
+class StatepathQueryCache:
+    # mode: 'contains' or 'fulltext', how the EVENT of the error message is looked up
+    def __init__(self, mode='contains'):
+        if mode not in EVENT_LOOKUPS:
+            raise ValueError(f'unknown EVENT lookup mode {mode!r}')
+        self.mode = mode
+        self.queries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(metapath_str):
+        # the (relType, srcKind, destKind, key) of every relationship, whatever the whitespace of the string is
+        return tuple(tuple(rel.strip().split(', ')) for rel in metapath_str.split(';')[:-1])
+
+    @staticmethod
+    def compile(signature, mode):
+        # follow the metapath from the EVENT, one alias per kind
+        query_parts = [statepath_event_lookup(mode)]
+        node_aliases = {"EVENT": "evt"}
+        idx = 1
+        for relType, srcKind, destKind, propertyValue in signature:
+            for kind in [srcKind, destKind]:
+                if kind not in node_aliases:
+                    node_aliases[kind] = f"n{idx}"
+                    idx += 1
+        for idx, (relType, srcKind, destKind, propertyValue) in enumerate(signature, start=1):
+            query_parts.append(f"""
+MATCH ({node_aliases[srcKind]}:{identifier(srcKind)})-[r{idx}:{identifier(relType)}]->({node_aliases[destKind]}:{identifier(destKind)})
+WHERE r{idx}.key = $keys[{idx - 1}]""")
+        nodes = list(node_aliases.values())
+        rels = [f"r{idx}" for idx in range(1, len(signature) + 1)]
+        assert len(nodes) == len(rels) + 1
+        return_vars = [None] * (len(nodes) + len(rels))
+        return_vars[::2] = nodes
+        return_vars[1::2] = rels
         query_parts.append(f"""
-MATCH ({srcAlias}:{srcKind})-[r{idx}:{relType}]->({destAlias}:{destKind})
-WHERE r{idx}.key = {repr(propertyValue)}""")
-
-    # Construct the RETURN Statement
-    nodes = list(node_aliases.values())
-    rels = [f"r{idx}" for idx in range(1, len(metapath)+1)]
-    assert len(nodes) == len(rels) + 1
-
-    return_vars = [None]*(len(nodes)+len(rels))
-    return_vars[::2] = nodes
-    return_vars[1::2] = rels
-
-    query_parts.append(f"""
 RETURN {', '.join(return_vars)}""")
-
-    # Combine all parts into a complete Cypher query
-    complete_query = '\n'.join(query_parts) # or '\n'.join() with new line
-    
-    print(f'the human generated cypher query is: \n{complete_query}')
-    return complete_query.strip()
-
-
+        return '\n'.join(query_parts).strip()
+
+    def query(self, metapath_str, error_message, mode=None):
+        # return the compiled query and its parameters, mode overrides the EVENT lookup mode of the cache
+        mode = mode or self.mode
+        signature = self.signature(metapath_str)
+        with self.lock:
+            cypher_query = self.queries.get((signature, mode))
+            if cypher_query is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if cypher_query is None:
+            cypher_query = self.compile(signature, mode)
+            with self.lock:
+                self.queries[(signature, mode)] = cypher_query
+        parameters = event_lookup_parameters(error_message, mode)
+        parameters['keys'] = [rel[3] for rel in signature]
+        return cypher_query, parameters
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'compiled': len(self.queries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else None}
+
+
+# the compiled queries of the deterministic path, unless the caller passes its own cache
+STATEPATH_QUERY_CACHE = StatepathQueryCache()
+
+
+# the deterministic query of the metapath and its parameters, compiled once per metapath
+def human_generate_cypher_query(metapath_str, error_message, query_cache=None, mode=None):
+    cypher_query, parameters = (query_cache or STATEPATH_QUERY_CACHE).query(metapath_str, error_message, mode)
+    print(f'the human generated cypher query is: \n{cypher_query}')
+    return cypher_query, parameters
+
+
+# ask the generator for the statepath query, feed the errors back and retry up to max_attempts times,
+# return the last query, its compatible records and the number of attempts
+def llm_compile_statepath_query(query_executor, extend_metapath, error_message, cypherQueryGenerator, limit=None,
+                                max_attempts=3):
+    cypher_query, records = None, []
+    for attempt in range(max_attempts):
+        try:
+            print('%' * 100)
+            print(f'attempt = {attempt}\n')
+            print(f'generate cypher query for the following extended metapath: \n {extend_metapath}')
+            cypher_query = generate_cypher_query(extend_metapath, error_message, cypherQueryGenerator)
+            records = run_and_filter_query(query_executor, cypher_query, limit)
+            # if succeed
+            return cypher_query, records, attempt + 1
+        except neo4j.exceptions.CypherSyntaxError as e:
+            print(f"Cypher Syntax Error occurred: {str(e)}")
+            exception_message = f"The previous generated cypher query encounters the following exception:\
+            \nCypher Syntax Error occurred: {str(e)}\
+            \nBased on the exception details above, please generate a corrected version of the Cypher query."
+            cypherQueryGenerator.add_message(exception_message)
+        except Exception as e:
+            print(f"An unexpected error occurred: {str(e)}")
+            exception_message = f"The previous generated cypher query encounters the following exception:\
+            \nAn unexpected error occurred: {str(e)}\
+            \nBased on the exception details above, please generate a corrected version of the Cypher query."
+            cypherQueryGenerator.add_message(exception_message)
+    return cypher_query, [], max_attempts
+
+
+def human_compile_statepath_query(query_executor, extend_metapath, error_message, limit=None, query_cache=None):
+    # the deterministic query, compiled once per metapath, an error counts as no records, so the caller can fall back
+    print('#' * 100)
+    print(f'manually generate cypher query for the following extended metapath: \n {extend_metapath}')
+    query_cache = query_cache or STATEPATH_QUERY_CACHE
+    try:
+        cypher_query, parameters = human_generate_cypher_query(extend_metapath, error_message, query_cache)
+    except ValueError as e:
+        print(f"The metapath can not be compiled: {str(e)}")
+        return None, []
+    try:
+        records = run_and_filter_query(query_executor, cypher_query, limit, parameters)
+        if (len(records) == 0) and (query_cache.mode == 'fulltext'):
+            # the phrase match works on tokens, a message cut in the middle of a token is looked up with CONTAINS
+            cypher_query, parameters = human_generate_cypher_query(extend_metapath, error_message, query_cache,
+                                                                   'contains')
+            records = run_and_filter_query(query_executor, cypher_query, limit, parameters)
+        return cypher_query, records
+    except neo4j.exceptions.Neo4jError as e:
+        print(f"The human generated cypher query failed: {str(e)}")
+        return cypher_query, []
+
+
+def ledger_tokens(ledger, start):
+    # the total tokens of the runs recorded in the ledger since it had start entries
+    if ledger is None:
+        return None
+    return sum(entry['total_tokens'] for entry in ledger.entries[start:])
+
+
+# strategy:
+#   'deterministic-first' runs human_generate_cypher_query at first, the generator is asked only when that query
+#                         errors or has no compatible records
+#   'llm-first' asks the generator at first and falls back to human_generate_cypher_query (the original flow)
+# return the records and how the query was compiled: the path it took (deterministic, llm, llm-fallback,
+# deterministic-fallback), the queries, the generator attempts, the latency and the generator tokens
+# query_cache: the StatepathQueryCache of the deterministic queries, STATEPATH_QUERY_CACHE by default
+def compile_statepath_query(query_executor, extend_metapath, error_message, cypherQueryGenerator, limit=None,
+                            strategy='deterministic-first', max_attempts=3, query_cache=None):
+    ledger = getattr(cypherQueryGenerator, 'ledger', None)
+    ledger_start = len(ledger.entries) if ledger is not None else 0
+    start_time = time.time()
+    compilation = {'strategy': strategy, 'cypher_attempts': 0}
+    if strategy == 'deterministic-first':
+        cypher_query, records = human_compile_statepath_query(query_executor, extend_metapath, error_message, limit,
+                                                              query_cache)
+        compilation['human_cypher_query'] = cypher_query
+        compilation['path'] = 'deterministic'
+        if len(records) == 0:
+            cypher_query, records, attempts = llm_compile_statepath_query(
+                query_executor, extend_metapath, error_message, cypherQueryGenerator, limit, max_attempts)
+            compilation.update({'cypher_query': cypher_query, 'cypher_attempts': attempts, 'path': 'llm-fallback'})
+    elif strategy == 'llm-first':
+        cypher_query, records, attempts = llm_compile_statepath_query(
+            query_executor, extend_metapath, error_message, cypherQueryGenerator, limit, max_attempts)
+        compilation.update({'cypher_query': cypher_query, 'cypher_attempts': attempts, 'path': 'llm'})
+        # if gpt4 can not generate a working query, or the result of the query is empty (usually due to semantic error)
+        # we will try it again with human_generate_cypher_query
+        if len(records) == 0:
+            cypher_query, records = human_compile_statepath_query(query_executor, extend_metapath, error_message, limit,
+                                                                  query_cache)
+            compilation.update({'human_cypher_query': cypher_query, 'path': 'deterministic-fallback'})
+    else:
+        raise ValueError(f'unknown cypher compilation strategy {strategy!r}')
+    compilation['latency'] = time.time() - start_time
+    compilation['llm_tokens'] = ledger_tokens(ledger, ledger_start)
+    compilation['records'] = len(records)
+    return records, compilation
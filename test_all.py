@@ -9,6 +9,7 @@ from openai import OpenAI
 from neo4j import GraphDatabase
 
 from common.neo4j_query_executor import Neo4jQueryExecutor
+from common.kind_catalog import KindCatalog
 from common.openai_generic_assistant import OpenAIGenericAssistant
 
 from find_metapath.find_srckind_metapath_neo4j import *
@@ -26,7 +27,8 @@ def main():
     rootCauseLocator = setup_root_cause_locator()
 
     print('find native and external kinds and build prompt template')
-    nativeKinds, externalKinds = find_native_external_kinds(metagraph_query_executor)
+    kindCatalog = KindCatalog.load(metagraph_query_executor)
+    nativeKinds, externalKinds = kindCatalog.nativeKinds, kindCatalog.externalKinds
     promptTemplate = build_prompt_template(nativeKinds, externalKinds)
 
     print('setup cypher_generator')
@@ -88,7 +90,7 @@ def main():
         destKind = destRelevant['DestinationKind']
         relevantResources = destRelevant['RelevantResources']
         #intermediateKinds = [x for x in relevantResources if x not in [srcKind, destKind]]
-        intermediateKinds = [x for x in relevantResources if (x not in [srcKind, destKind]) and (x in nativeKinds or x in externalKinds)]
+        intermediateKinds = [x for x in relevantResources if (x not in [srcKind, destKind]) and (x in kindCatalog)]
         
         # 
         metapaths = find_metapath(metagraph_query_executor, srcKind, destKind, intermediateKinds)
@@ -96,39 +98,10 @@ def main():
             # generate cypher query based on the extended metapath string (with EVENT and Event)
             extend_metapath = extend_metapath_construct_string(metapath)
            
-            max_attempts = 3
-            for attempt in range(max_attempts): 
-                try:
-                    print('%' * 100)
-                    print(f'attempt = {attempt}\n')
-                    print(f'generate cypher query for the following extended metapath: \n {extend_metapath}')
-                    cypher_query = generate_cypher_query(extend_metapath, errorMessage, cypherQueryGenerator)
-                    records = run_and_filter_query(stategraph_query_executor, cypher_query)
-                    # if succeed
-                    break
-                except neo4j.exceptions.CypherSyntaxError as e:
-                    print(f"Cypher Syntax Error occurred: {str(e)}")
-                    exception_message = f"The previous generated cypher query encounters the following exception:\
-                    \nCypher Syntax Error occurred: {str(e)}\
-                    \nBased on the exception details above, please generate a corrected version of the Cypher query."
-                    cypherQueryGenerator.add_message(exception_message)
-                    continue
-                except Exception as e:
-                    print(f"An unexpected error occurred: {str(e)}")
-                    exception_message = f"The previous generated cypher query encounters the following exception:\
-                    \nAn unexpected error occurred: {str(e)}\
-                    \nBased on the exception details above, please generate a corrected version of the Cypher query."
-                    cypherQueryGenerator.add_message(exception_message)
-                    continue 
-
-            # if gpt4 can not generate syntax-correct query, 
-            # or the result of the query is empty (usually due to semantic error)
-            # we will try it again with human_generate_cypher_query
-            if (attempt == max_attempts-1) or (len(records) == 0):
-                print('#' * 100)
-                print(f'manually generate cypher query for the following extended metapath: \n {extend_metapath}') 
-                cypher_query_2 = human_generate_cypher_query(extend_metapath, errorMessage) 
-                records = run_and_filter_query(stategraph_query_executor, cypher_query_2)
+            # the deterministic query first, the cypher generator only when it fails
+            records, compilation = compile_statepath_query(stategraph_query_executor, extend_metapath, errorMessage,
+                                                           cypherQueryGenerator)
+            print(f"the statepath query took the {compilation['path']} path in {compilation['latency']:.3f} seconds")
 
             for record in records:
                 report, path_clues = check_statepath(stategraph_query_executor, semanticAnalyzer, record)
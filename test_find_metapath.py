@@ -8,6 +8,7 @@ from openai import OpenAI
 from neo4j import GraphDatabase
 
 from common.neo4j_query_executor import Neo4jQueryExecutor
+from common.kind_catalog import KindCatalog
 #from openai_root_cause_locator import OpenAIRootCauseLocator
 #from openai_root_cause_locator import build_prompt_template
 
@@ -22,7 +23,8 @@ def main():
 
     print('find native and external kinds and build prompt template')
     # find native and external kinds, build prompt template
-    nativeKinds, externalKinds = find_native_external_kinds(metagraph_query_executor)
+    kindCatalog = KindCatalog.load(metagraph_query_executor)
+    nativeKinds, externalKinds = kindCatalog.nativeKinds, kindCatalog.externalKinds
     promptTemplate = build_prompt_template(nativeKinds, externalKinds)
 
     print('create openai client with assistant and thread')
@@ -58,7 +60,7 @@ def main():
         destKind = destRelevant['DestinationKind']
         relevantResources = destRelevant['RelevantResources']
         #intermediateKinds = [x for x in relevantResources if x not in [srcKind, destKind]]
-        intermediateKinds = [x for x in relevantResources if (x not in [srcKind, destKind]) and (x in nativeKinds or x in externalKinds)]
+        intermediateKinds = [x for x in relevantResources if (x not in [srcKind, destKind]) and (x in kindCatalog)]
 
         find_metapath(metagraph_query_executor, srcKind, destKind, intermediateKinds)
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import uuid
+
+from common.neo4j_query_executor import Neo4jQueryExecutor
+from common.neo4j_schema import ensure_indexes, STATEGRAPH_INDEXES
+
+from find_metapath.find_srckind_metapath_neo4j import *
+
+
+# the synthetic Event/EVENT/Pod nodes carry this property, so they are removed after the benchmark
+BENCHMARK_TAG = 'srckind-fulltext-benchmark'
+
+CREATE_EVENTS_QUERY = """
+    UNWIND $events AS event
+    CREATE (n1:Event {id: event.id, kind: 'Event', benchmark: $tag})
+    CREATE (N1:EVENT {id: event.id, kind: 'Event', message: event.message, benchmark: $tag})
+    CREATE (n2:Pod {id: event.podId, kind2: 'Pod', benchmark: $tag})
+    CREATE (n1)-[:HasEvent]->(N1)
+    CREATE (n1)-[:ReferInternal {key: 'involvedObject_uid'}]->(n2)
+    """
+
+DELETE_EVENTS_QUERY = """
+    MATCH (n:Event|EVENT|Pod {benchmark: $tag})
+    WITH n LIMIT 10000
+    DETACH DELETE n
+    RETURN count(*) AS deleted
+    """
+
+
+def build_message(i):
+    return f'MountVolume.SetUp failed for volume "pvc-{i:08d}" : configmap "bench-configmap-{uuid.uuid4().hex[:8]}" not found'
+
+
+def create_events(query_executor, count, batch_size=5000):
+    messages = []
+    for start in range(0, count, batch_size):
+        events = []
+        for i in range(start, min(start + batch_size, count)):
+            message = build_message(i)
+            messages.append(message)
+            events.append({'id': str(uuid.uuid4()), 'podId': str(uuid.uuid4()), 'message': message})
+        query_executor.run_write_query(CREATE_EVENTS_QUERY, {'events': events, 'tag': BENCHMARK_TAG})
+    # the full-text index is eventually consistent, wait until it has the new nodes
+    query_executor.run_write_query('CALL db.awaitIndexes(300)')
+    return messages
+
+
+def delete_events(query_executor):
+    while query_executor.run_write_query(DELETE_EVENTS_QUERY, {'tag': BENCHMARK_TAG})[0]['deleted'] > 0:
+        pass
+
+
+def time_lookups(query_executor, messages, mode):
+    start_time = time.time()
+    for message in messages:
+        find_srcKind(query_executor, message, mode)
+    return (time.time() - start_time) / len(messages)
+
+
+def main():
+    # the benchmark writes (and removes) synthetic nodes, so it never defaults to the stategraph of the other drivers,
+    # the uri of a scratch copy is given as the first argument or SCRATCH_STATEGRAPH_URI
+    uri = sys.argv[1] if len(sys.argv) > 1 else os.getenv('SCRATCH_STATEGRAPH_URI')
+    if not uri:
+        sys.exit('usage: %s <bolt uri of a scratch copy of the stategraph> (or set SCRATCH_STATEGRAPH_URI)'
+                 % sys.argv[0])
+
+    print("create executor and init connection")
+    stategraph_query_executor = Neo4jQueryExecutor(uri, "neo4j", "yong")
+    ensure_indexes(stategraph_query_executor, STATEGRAPH_INDEXES, 'stategraph')
+
+    event_counts = [1000, 10000, 100000]
+    lookups = 20
+    results = []
+    try:
+        created = 0
+        messages = []
+        for event_count in event_counts:
+            messages += create_events(stategraph_query_executor, event_count - created)
+            created = event_count
+            # look up the messages spread over the whole history
+            samples = messages[::max(1, len(messages) // lookups)][:lookups]
+            # warm up the plan cache of both queries
+            find_srcKind(stategraph_query_executor, samples[0], 'contains')
+            find_srcKind(stategraph_query_executor, samples[0], 'fulltext')
+            contains_latency = time_lookups(stategraph_query_executor, samples, 'contains')
+            fulltext_latency = time_lookups(stategraph_query_executor, samples, 'fulltext')
+            results.append((event_count, contains_latency, fulltext_latency))
+    finally:
+        print("remove the synthetic events")
+        delete_events(stategraph_query_executor)
+
+    print('*' * 100)
+    print('%12s %16s %16s %10s' % ('EVENTs', 'contains (ms)', 'fulltext (ms)', 'speedup'))
+    for event_count, contains_latency, fulltext_latency in results:
+        print('%12d %16.2f %16.2f %10.1f' % (event_count, contains_latency * 1000, fulltext_latency * 1000,
+                                              contains_latency / fulltext_latency))
+    print('*' * 100)
+
+    print("close connection")
+    stategraph_query_executor.close()
+
+
+if __name__ == "__main__":
+    main()
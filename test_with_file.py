@@ -6,36 +6,112 @@ import time
 import json
 import neo4j
 import csv
+import collections
 from itertools import islice
 from openai import OpenAI
 from neo4j import GraphDatabase
 
 from common.neo4j_query_executor import Neo4jQueryExecutor
 from common.openai_generic_assistant import OpenAIGenericAssistant
+from common.llm_response_cache import LLMResponseCache
+from common.token_ledger import TokenLedger
+from common.llm_scheduler import LLMScheduler
+from common.llm_replay import LLMRecording
+from common.assistant_registry import AssistantRegistry
+from common.neo4j_schema import bootstrap_schema
+from common.query_profiler import QueryProfiler
+from common.kind_catalog import KindCatalog, metagraph_fingerprint
 
 from find_metapath.find_srckind_metapath_neo4j import *
+from find_metapath.metapath_index import MetapathIndex
 from generate_query.generate_query import *
 from check_state.analyze_root_cause import *
 
+# a metapath of the statepath queries whose plans are checked at startup
+EXAMPLE_METAPATH = 'HasEvent, Event, EVENT, metadata_uid; ReferInternal, Event, Pod, involvedObject_uid; ' \
+                   'ReferInternal, Pod, ConfigMap, spec_volumes_configMap_name;'
+
 def main():
     print("create executor and init connection")
     # Create an instance of the executor class
-    metagraph_query_executor = Neo4jQueryExecutor("bolt://10.1.0.176:7687", "neo4j", "yong")
-    stategraph_query_executor = Neo4jQueryExecutor("bolt://10.1.0.174:7687", "neo4j", "yong")
+    # the latency and record count of every query by stage, set profile_db_hits=True to PROFILE the db hits too
+    query_profiler = QueryProfiler(profile_db_hits=False)
+    metagraph_query_executor = Neo4jQueryExecutor("bolt://10.1.0.176:7687", "neo4j", "yong", profiler=query_profiler)
+    stategraph_query_executor = Neo4jQueryExecutor("bolt://10.1.0.174:7687", "neo4j", "yong", profiler=query_profiler)
+    # make sure the indexes of the hot queries exist, and warn for the query plans that still scan
+    bootstrap_schema(metagraph_query_executor, stategraph_query_executor,
+                     stategraph_queries={'find_srcKind': (SRCKIND_QUERY, {'message': ''}),
+                                         'find_srcKind (fulltext)': find_srcKind_query('', 'fulltext'),
+                                         'find_strict_states': find_strict_states('Pod', '', ''),
+                                         'find_entity': find_entity('Pod', ''),
+                                         'find_batched_states': find_batched_states([('Pod', '', '')]),
+                                         'statepath': StatepathQueryCache().query(EXAMPLE_METAPATH, ''),
+                                         'statepath (fulltext)': StatepathQueryCache().query(EXAMPLE_METAPATH, '',
+                                                                                             'fulltext')})
+
+    # 'assistants' keeps one thread per assistant for the whole batch,
+    # 'chat' sends only the instructions and the current request, so per-message cost stays constant
+    backend = 'assistants'
+    # the responses of byte-identical requests are answered from disk, set bypass=True to refresh them
+    response_cache = LLMResponseCache('./cache/llm_responses')
+    # the usage of every run is captured when the run completes, labeled by message and stage
+    ledger = TokenLedger()
+    # all assistants share the account limits, set them to the RPM/TPM of the account
+    scheduler = LLMScheduler(requests_per_minute=500, tokens_per_minute=40000)
+    # the Assistants created by the previous runs are looked up instead of created again
+    registry = AssistantRegistry('./cache/assistant_registry.json')
+    # structured output constrains the responses to JSON schemas, so they parse without retries,
+    # it needs a model that supports it
+    structured_output = False
+    model = 'gpt-4o' if structured_output else 'gpt-4'
+    assistant_options = {'response_cache': response_cache, 'ledger': ledger, 'scheduler': scheduler,
+                         'registry': registry, 'structured_output': structured_output}
+
+    # 'live': call the API
+    # 'record': call the API and record the responses, usage and latency into the fixture
+    # 'replay': answer from the fixture without the API, set simulate_latency to sleep for the recorded latency
+    llm_mode = 'live'
+    if llm_mode == 'record':
+        assistant_options['recording'] = LLMRecording('./fixtures/llm_recording.json')
+    elif llm_mode == 'replay':
+        backend = 'replay'
+        assistant_options = {'ledger': ledger, 'recording': LLMRecording('./fixtures/llm_recording.json'),
+                             'simulate_latency': False}
+
+    # analyze at most max_statepaths statepaths per metapath, the query stops pulling the rest, None for all
+    max_statepaths = None
+    # 'fulltext' looks the EVENT message up in the full-text index, 'contains' scans the EVENT messages
+    srckind_mode = 'fulltext'
+    # check only the top metapaths, ranked by the relevant resources of the locator, None for all shortest metapaths
+    metapath_top_k = 3
+    # 'deterministic-first' asks the cypher generator only when the deterministic query fails, 'llm-first' at first
+    cypher_strategy = 'deterministic-first'
+    # the number of metapaths per compilation path, i.e, deterministic / llm-fallback
+    compilation_paths = collections.Counter()
+    # the deterministic statepath queries are compiled once per metapath, and look the EVENT up like find_srcKind
+    statepath_query_cache = StatepathQueryCache(srckind_mode)
 
     print('create openai client with assistant and thread')
     print('setup root_cause_locator') 
-    rootCauseLocator = setup_root_cause_locator()
+    rootCauseLocator = setup_root_cause_locator(backend, model, **assistant_options)
 
     print('find native and external kinds and build prompt template')
-    nativeKinds, externalKinds = find_native_external_kinds(metagraph_query_executor)
-    promptTemplate = build_prompt_template(nativeKinds, externalKinds)
+    # the kinds and the metapath index are read from disk unless the metagraph changed since they were built
+    metagraph_version = metagraph_fingerprint(metagraph_query_executor)
+    kindCatalog = KindCatalog.load(metagraph_query_executor, './cache/kind_catalog.json', metagraph_version)
+    nativeKinds, externalKinds = kindCatalog.nativeKinds, kindCatalog.externalKinds
+    promptTemplate = build_prompt_template(nativeKinds, externalKinds, structured_output)
+    # the metagraph is small and static, the metapaths are looked up in the precomputed index,
+    # the metagraph is loaded only to rebuild the index when it changed
+    metagraph = MetapathIndex.load_or_build('./cache/metapath_index.json', metagraph_query_executor, metagraph_version)
+    # the labels of the state queries are drawn from the kinds of the metagraph only
+    register_entity_kinds(kindCatalog.kinds)
 
     print('setup cypher_generator')
-    cypherQueryGenerator = setup_cypher_generator()
+    cypherQueryGenerator = setup_cypher_generator(backend, model, **assistant_options)
 
     print('setup state_semantic_analyzer')
-    semanticAnalyzer = setup_state_semantic_analyzer()
+    semanticAnalyzer = setup_state_semantic_analyzer(backend, model, **assistant_options)
 
     #time.sleep(300)
    
@@ -61,8 +137,9 @@ def main():
     # total time cost for the code
     start_time = time.time()
 
-    for errorMessage in errorMessages[1:2]:
+    for message_index, errorMessage in enumerate(errorMessages[1:2]):
         inner_start_time = time.time() 
+        ledger.begin_message(message_index)
 
         result = dict()
         result['error_message'] = errorMessage
@@ -71,7 +148,7 @@ def main():
 
         # find srcKind in stategraph according to message, (Event)-[involvedObject_uid]->(srcKind)
         print('test find_srcKind()')
-        srcKind = find_srcKind(stategraph_query_executor, errorMessage)
+        srcKind = find_srcKind(stategraph_query_executor, errorMessage, srckind_mode)
 
         # find destKind and relevantResources with gpt4 assistant
         max_attempts = 3
@@ -103,9 +180,14 @@ def main():
         destKind = destRelevant['DestinationKind']
         relevantResources = destRelevant['RelevantResources']
         intermediateKinds = [x for x in relevantResources if (x not in [srcKind, destKind])\
-                                and (x in nativeKinds or x in externalKinds)]
+                                and (x in kindCatalog)]
         
-        metapaths = find_metapath(metagraph_query_executor, srcKind, destKind, intermediateKinds)
+        if metapath_top_k is None:
+            metapaths = find_metapath(metagraph_query_executor, srcKind, destKind, intermediateKinds, metagraph)
+        else:
+            # only the most promising metapaths go through the cypher generation and the state checks,
+            # ranked by their coverage of the relevant resources known to the metagraph
+            metapaths = find_ranked_metapaths(metagraph, srcKind, destKind, intermediateKinds, metapath_top_k)
         
         result['analysis'] = list()
         for metapath in metapaths:
@@ -115,49 +197,23 @@ def main():
             analysis = dict()
             analysis['extend_metapath'] = extend_metapath
 
-            max_attempts = 3
-            for attempt in range(max_attempts): 
-                try:
-                    print('%' * 100)
-                    print(f'attempt = {attempt}\n')
-                    print(f'generate cypher query for the following extended metapath: \n {extend_metapath}')
-                    cypher_query = generate_cypher_query(extend_metapath, errorMessage, cypherQueryGenerator)
-                    records = run_and_filter_query(stategraph_query_executor, cypher_query)
-                    # if succeed
-                    break
-                except neo4j.exceptions.CypherSyntaxError as e:
-                    print(f"Cypher Syntax Error occurred: {str(e)}")
-                    exception_message = f"The previous generated cypher query encounters the following exception:\
-                    \nCypher Syntax Error occurred: {str(e)}\
-                    \nBased on the exception details above, please generate a corrected version of the Cypher query."
-                    cypherQueryGenerator.add_message(exception_message)
-                    continue
-                except Exception as e:
-                    print(f"An unexpected error occurred: {str(e)}")
-                    exception_message = f"The previous generated cypher query encounters the following exception:\
-                    \nAn unexpected error occurred: {str(e)}\
-                    \nBased on the exception details above, please generate a corrected version of the Cypher query."
-                    cypherQueryGenerator.add_message(exception_message)
-                    continue 
-            # only add once 
-            analysis['cypher_query'] = cypher_query   
-            analysis['cypher_attempts'] = attempt + 1
-
-            # if gpt4 can not generate syntax-correct query, 
-            # or the result of the query is empty (usually due to semantic error)
-            # we will try it again with human_generate_cypher_query
-            if (attempt == max_attempts-1) or (len(records) == 0):
-                print('#' * 100)
-                print(f'manually generate cypher query for the following extended metapath: \n {extend_metapath}') 
-                cypher_query_2 = human_generate_cypher_query(extend_metapath, errorMessage) 
-                records = run_and_filter_query(stategraph_query_executor, cypher_query_2)
-                
-                analysis['human_cypher_query'] = cypher_query_2
+            # the deterministic query first, the cypher generator only when it fails (see cypher_strategy)
+            records, compilation = compile_statepath_query(stategraph_query_executor, extend_metapath, errorMessage,
+                                                           cypherQueryGenerator, max_statepaths, cypher_strategy,
+                                                           query_cache=statepath_query_cache)
+            analysis['cypher_query'] = compilation.get('cypher_query')
+            analysis['cypher_attempts'] = compilation['cypher_attempts']
+            if 'human_cypher_query' in compilation:
+                analysis['human_cypher_query'] = compilation['human_cypher_query']
+            analysis['compilation'] = compilation
+            compilation_paths[compilation['path']] += 1
 
             analysis['statepath'] = list()
             sp = dict()
+            # the states of all entities on all statepaths are looked up in one query
+            state_lookup = lookup_statepath_states(stategraph_query_executor, records)
             for record in records:
-                report, path_clues = check_statepath(stategraph_query_executor, semanticAnalyzer, record)
+                report, path_clues = check_statepath(stategraph_query_executor, semanticAnalyzer, record, state_lookup)
                 print(report)
                 '''
                 for k in path_clues.keys():
@@ -174,29 +230,10 @@ def main():
         inner_end_time = time.time()
         result['time_cost'] = inner_end_time - inner_start_time
         
-        # we caculate the token cost for each message, 
-        # including rootCauseLocator, cypherQueryGenerator and semanticAnalyzer 
-        tmin = int(inner_start_time)
-        tmax = int(inner_end_time)
-        
-        # at most 3 retries for each message 
-        token_usage_1 = rootCauseLocator.get_token_usage(tmin, tmax, 10) 
-        # at most 3 retries for each metapath, we find 2 metapaths at most now  
-        token_usage_2 = cypherQueryGenerator.get_token_usage(tmin, tmax, 20) 
-        # metapath from srckind to destkind has at most 3 edges, namely 4 nodes
-        # therefore, at most 4 STATE nodes to check for each metapath
-        token_usage_3 = semanticAnalyzer.get_token_usage(tmin, tmax, 30)
-
-        token_usage = dict()
-        token_usage['prompt_tokens'] = token_usage_1['prompt_tokens'] +\
-                                    token_usage_2['prompt_tokens'] + token_usage_3['prompt_tokens']
-        token_usage['completion_tokens'] = token_usage_1['completion_tokens'] +\
-                                    token_usage_2['completion_tokens'] + token_usage_3['completion_tokens']
-        token_usage['total_tokens'] = token_usage_1['total_tokens'] +\
-                                    token_usage_2['total_tokens'] + token_usage_3['total_tokens']
-        
-        result['token_usage'] = token_usage
-        #result['token_usage_details'] = [token_usage_1, token_usage_2, token_usage_3]
+        # we caculate the token cost for each message from the ledger,
+        # including rootCauseLocator (locator), cypherQueryGenerator (cypher) and semanticAnalyzer (semantic)
+        result['token_usage'] = ledger.usage(message_index)
+        result['token_usage_details'] = ledger.usage_by_stage(message_index)
 
         # write the result for an error_message
         with open(output_filename, 'a') as json_file:
@@ -217,6 +254,15 @@ def main():
 
     print('*' * 100)
     print(f"The code started at {formated_start_time}, ended at {formated_end_time}, and ran for {time_lapsed} seconds.")
+    print(f"The response cache stats: {response_cache.stats()}")
+    print(f"The scheduler stats: {scheduler.stats}")
+    print(f"The stategraph repeated query stats: {stategraph_query_executor.repeated_query_stats()}")
+    print(f"The cypher compilation paths: {dict(compilation_paths)}")
+    print(f"The statepath query cache stats: {statepath_query_cache.stats()}")
+    # the query histograms of the run are written next to the results
+    profile_filename = output_filename.replace('.json', '-query-profile.json')
+    query_profiler.save(profile_filename)
+    print(f"The query profile by stage: {profile_filename}")
     print('*' * 100)
 
     print("close connection")